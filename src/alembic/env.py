@@ -1,4 +1,5 @@
 import os
+import sys
 from logging.config import fileConfig
 
 from sqlalchemy import engine_from_config
@@ -17,6 +18,10 @@ config.set_main_option("sqlalchemy.url", os.environ["DATABASE_URL"])
 if config.config_file_name is not None:
     fileConfig(config.config_file_name)
 
+# lets migrations import the helpers next to this file: `from online_migrations import ...`
+sys.path.insert(0, os.path.dirname(__file__))
+from online_migrations import MIGRATION_LOCK_TIMEOUT
+
 # add your model's MetaData object here
 # for 'autogenerate' support
 # from myapp import mymodel
@@ -66,6 +71,8 @@ def run_migrations_online() -> None:
         config.get_section(config.config_ini_section, {}),
         prefix="sqlalchemy.",
         poolclass=pool.NullPool,
+        # DDL waiting for a lock blocks every query queued behind it, fail instead and retry later
+        connect_args={'options': f'-c lock_timeout={MIGRATION_LOCK_TIMEOUT}'},
     )
 
     with connectable.connect() as connection:
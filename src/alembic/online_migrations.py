@@ -0,0 +1,136 @@
+"""Helpers for changing large tables (submissions) while the API keeps serving.
+
+- Every migration runs with `lock_timeout` = MIGRATION_LOCK_TIMEOUT (set in env.py), so DDL that
+  can't get its lock fails fast instead of queueing, and blocking all traffic queued behind it.
+- Indexes are built and dropped CONCURRENTLY, outside the migration transaction.
+- Constraints are added NOT VALID (instant) and validated separately, which doesn't block writes.
+- Backfills update in batches of primary key ranges, each committed on its own.
+
+Operations that run outside the migration transaction are not rolled back if a later step fails,
+so each helper can be safely re-run.
+"""
+import os
+import time
+from contextlib import contextmanager
+from typing import List, Optional, Union
+
+import sqlalchemy as sa
+from alembic import op
+
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 5000))
+BACKFILL_PAUSE_SECONDS = float(os.environ.get('BACKFILL_PAUSE_SECONDS', 0.05))
+
+
+@contextmanager
+def lock_timeout(timeout: str):
+    op.execute(f"SET lock_timeout = '{timeout}'")
+    try:
+        yield
+    finally:
+        op.execute(f"SET lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+
+
+def _drop_invalid_index(name: str) -> None:
+    # an interrupted CREATE INDEX CONCURRENTLY leaves an invalid index behind, which IF NOT EXISTS would keep
+    if op.get_context().as_sql:
+        return
+
+    query = sa.text('SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)')
+    if op.get_bind().execute(query, {'name': name}).scalar():
+        op.execute(f'DROP INDEX CONCURRENTLY {name}')
+
+
+def create_index_concurrently(name: str, table: str, columns: List[Union[str, sa.TextClause]], **kw) -> None:
+    """
+    op.create_index without blocking writes to the table. The build waits for transactions that
+    are already running to finish, which doesn't hold up new ones, so the lock timeout is lifted.
+    """
+
+    with op.get_context().autocommit_block():
+        with lock_timeout('0'):
+            _drop_invalid_index(name)
+            op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True, **kw)
+
+
+def drop_index_concurrently(name: str, table: str) -> None:
+    with op.get_context().autocommit_block():
+        with lock_timeout('0'):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+
+
+def add_check_constraint(name: str, table: str, condition: str, validate: bool = True) -> None:
+    """
+    Add a CHECK constraint as NOT VALID, which only takes a brief lock, then VALIDATE it, which scans
+    the table without blocking reads or writes. Rows written in between are already checked.
+    """
+
+    op.create_check_constraint(name, table, condition, postgresql_not_valid=True)
+    if validate:
+        validate_constraint(name, table)
+
+
+def add_foreign_key(name: str, source_table: str, referent_table: str, local_cols: List[str],
+                    remote_cols: List[str], validate: bool = True, **kw) -> None:
+    op.create_foreign_key(name, source_table, referent_table, local_cols, remote_cols, postgresql_not_valid=True,
+                          **kw)
+    if validate:
+        validate_constraint(name, source_table)
+
+
+def validate_constraint(name: str, table: str) -> None:
+    # committed separately, so the ACCESS EXCLUSIVE lock of the ADD CONSTRAINT isn't held while scanning
+    with op.get_context().autocommit_block():
+        op.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {name}')
+
+
+def set_not_null(table: str, column: str) -> None:
+    """
+    ALTER COLUMN ... SET NOT NULL without a full table scan under an exclusive lock: a validated
+    CHECK (column IS NOT NULL) lets Postgres skip the scan, and is dropped afterwards.
+    """
+
+    name = f'ck_{table}_{column}_not_null'
+    add_check_constraint(name, table, f'{column} IS NOT NULL')
+    op.alter_column(table, column, nullable=False)
+    op.drop_constraint(name, table, type_='check')
+
+
+def backfill(table: str, values: str, where: Optional[str] = None, batch_size: int = BACKFILL_BATCH_SIZE,
+             key: str = 'id', pause: float = BACKFILL_PAUSE_SECONDS) -> int:
+    """
+    UPDATE table SET `values` for the rows matching `where`, in ranges of `batch_size` keys, each
+    committed on its own, so row locks are short and vacuum can keep up.
+
+    `where` should exclude rows that are already done (e.g. `cost_basis IS NULL`): an interrupted
+    backfill then resumes by running the migration again, and finished ranges cost an index scan.
+
+    :return: number of rows updated.
+    """
+
+    context = op.get_context()
+    if context.as_sql:
+        condition = f' WHERE {where}' if where else ''
+        op.execute(f'UPDATE {table} SET {values}{condition}')
+        return 0
+
+    condition = f' AND ({where})' if where else ''
+    stmt = sa.text(f'UPDATE {table} SET {values} WHERE {key} > :low AND {key} <= :high{condition}')
+
+    updated = 0
+    with context.autocommit_block():
+        connection = op.get_bind()
+        low, high = connection.execute(sa.text(f'SELECT min({key}) - 1, max({key}) FROM {table}')).one()
+        if high is None:
+            return 0
+
+        started = time.monotonic()
+        while low < high:
+            updated += connection.execute(stmt, {'low': low, 'high': low + batch_size}).rowcount
+            low += batch_size
+            print(f'Backfilled {table} up to {key} {min(low, high)} of {high}, {updated} rows '
+                  f'in {time.monotonic() - started:.0f}s')
+            if pause:
+                time.sleep(pause)
+
+    return updated
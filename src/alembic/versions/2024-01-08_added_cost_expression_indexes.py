@@ -0,0 +1,43 @@
+"""added cost expression indexes on submissions
+
+Revision ID: 9c4e1d7a2b63
+Revises: ed7aa71905f8
+Create Date: 2024-01-08 12:10:24.418305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e1d7a2b63'
+down_revision: Union[str, None] = 'ed7aa71905f8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Must match the SQL rendered by the Submission.total_media_cost / Submission.cpm hybrids,
+# otherwise the planner will not use these indexes for sorting and filtering.
+TOTAL_MEDIA_COST = (
+    "submissions.no_of_periods * CASE "
+    "WHEN (submissions.cost_basis = 'one_week_media_cost') THEN submissions.one_week_media_cost "
+    "WHEN (submissions.cost_basis = 'two_week_media_cost') THEN submissions.two_week_media_cost "
+    "WHEN (submissions.cost_basis = 'three_week_media_cost') THEN submissions.three_week_media_cost "
+    "WHEN (submissions.cost_basis = 'four_week_media_cost') THEN submissions.four_week_media_cost END"
+)
+CPM = f"(({TOTAL_MEDIA_COST}) / CAST(nullif(submissions.a18_weekly_impressions, 0) AS NUMERIC)) * 1000"
+
+
+def upgrade() -> None:
+    create_index_concurrently('ix_submissions_project_id_total_media_cost', 'submissions',
+                              ['project_id', sa.text(f'({TOTAL_MEDIA_COST})')], unique=False)
+    create_index_concurrently('ix_submissions_project_id_cpm', 'submissions',
+                              ['project_id', sa.text(f'({CPM})')], unique=False)
+
+
+def downgrade() -> None:
+    drop_index_concurrently('ix_submissions_project_id_cpm', 'submissions')
+    drop_index_concurrently('ix_submissions_project_id_total_media_cost', 'submissions')
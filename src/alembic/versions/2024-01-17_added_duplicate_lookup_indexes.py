@@ -0,0 +1,33 @@
+"""added duplicate lookup indexes on submissions
+
+Revision ID: e4a90c2d5b17
+Revises: 9b76e5e18629
+Create Date: 2024-01-17 09:41:36.902514
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e4a90c2d5b17'
+down_revision: Union[str, None] = '9b76e5e18629'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # possible duplicates of a new submission are looked up by geopath_id and a lat/lon bounding box
+    create_index_concurrently('ix_submissions_project_id_geopath_id', 'submissions', ['project_id', 'geopath_id'],
+                              unique=False)
+    create_index_concurrently('ix_submissions_project_id_latitude', 'submissions', ['project_id', 'latitude'],
+                              unique=False)
+
+
+def downgrade() -> None:
+    drop_index_concurrently('ix_submissions_project_id_latitude', 'submissions')
+    drop_index_concurrently('ix_submissions_project_id_geopath_id', 'submissions')
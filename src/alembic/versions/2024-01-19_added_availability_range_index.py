@@ -0,0 +1,35 @@
+"""added availability range index on submissions
+
+Revision ID: 3d81f6c2a9e4
+Revises: e4a90c2d5b17
+Create Date: 2024-01-19 14:02:17.530948
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision: str = '3d81f6c2a9e4'
+down_revision: Union[str, None] = 'e4a90c2d5b17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Must match the SQL rendered by the Submission.availability hybrid
+AVAILABILITY = (
+    "CASE WHEN (submissions.availability_start > submissions.availability_end) THEN NULL "
+    "ELSE daterange(submissions.availability_start, submissions.availability_end, '[]') END"
+)
+
+
+def upgrade() -> None:
+    # serves the @> (whole campaign window) and && (part of it) availability filters
+    create_index_concurrently('ix_submissions_availability', 'submissions', [sa.text(f'({AVAILABILITY})')],
+                              unique=False, postgresql_using='gist')
+
+
+def downgrade() -> None:
+    drop_index_concurrently('ix_submissions_availability', 'submissions')
@@ -0,0 +1,27 @@
+"""added content_hash in submission
+
+Revision ID: 8f3b27d95c10
+Revises: 3d81f6c2a9e4
+Create Date: 2024-01-22 10:18:44.206113
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '8f3b27d95c10'
+down_revision: Union[str, None] = '3d81f6c2a9e4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # nullable without a default, so only the catalog changes; existing rows get a hash when next ingested
+    op.add_column('submissions', sa.Column('content_hash', sa.LargeBinary(length=16), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('submissions', 'content_hash')
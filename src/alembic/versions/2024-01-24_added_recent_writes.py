@@ -0,0 +1,32 @@
+"""added recent writes
+
+Revision ID: 5e0c94a7b218
+Revises: 8f3b27d95c10
+Create Date: 2024-01-24 09:41:12.530871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5e0c94a7b218'
+down_revision: Union[str, None] = '8f3b27d95c10'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('recent_writes',
+    sa.Column('user_id', sa.String(length=64), nullable=False),
+    sa.Column('created_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=True),
+    sa.Column('updated_at', sa.TIMESTAMP(), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('user_id'),
+    prefixes=['UNLOGGED']
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('recent_writes')
@@ -0,0 +1,45 @@
+"""replaced availability range index
+
+Revision ID: b7d2e19c4f60
+Revises: 5e0c94a7b218
+Create Date: 2024-01-25 11:06:39.184205
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from online_migrations import create_index_concurrently, drop_index_concurrently
+
+# revision identifiers, used by Alembic.
+revision: str = 'b7d2e19c4f60'
+down_revision: Union[str, None] = '5e0c94a7b218'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Must match the SQL rendered by the Submission.availability hybrid
+AVAILABILITY = (
+    "CASE WHEN (submissions.availability_start > submissions.availability_end) THEN NULL "
+    "WHEN (submissions.availability_start IS NULL AND submissions.availability_end IS NULL) THEN NULL "
+    "ELSE daterange(submissions.availability_start, submissions.availability_end, '[]') END"
+)
+
+# as of 3d81f6c2a9e4
+OLD_AVAILABILITY = (
+    "CASE WHEN (submissions.availability_start > submissions.availability_end) THEN NULL "
+    "ELSE daterange(submissions.availability_start, submissions.availability_end, '[]') END"
+)
+
+
+def upgrade() -> None:
+    # the new index is built before the old one is dropped, so the filters are never without one
+    create_index_concurrently('ix_submissions_known_availability', 'submissions', [sa.text(f'({AVAILABILITY})')],
+                              unique=False, postgresql_using='gist')
+    drop_index_concurrently('ix_submissions_availability', 'submissions')
+
+
+def downgrade() -> None:
+    create_index_concurrently('ix_submissions_availability', 'submissions', [sa.text(f'({OLD_AVAILABILITY})')],
+                              unique=False, postgresql_using='gist')
+    drop_index_concurrently('ix_submissions_known_availability', 'submissions')
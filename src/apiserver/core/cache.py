@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class LRUCache:
+    """
+    Thread-safe bounded mapping that evicts the least recently used entry once `maxsize` is reached.
+
+    Sync route handlers run on the threadpool, so every access goes through a lock.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ExpiringSet:
+    """
+    Bounded set whose members drop out `ttl` seconds after they were last added.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self._deadlines = LRUCache(maxsize)
+
+    def add(self, key: Hashable) -> None:
+        self._deadlines.set(key, time.monotonic() + self.ttl)
+
+    def __contains__(self, key: Hashable) -> bool:
+        deadline = self._deadlines.get(key)
+        if deadline is None:
+            return False
+        if deadline < time.monotonic():
+            self._deadlines.pop(key)
+            return False
+        return True
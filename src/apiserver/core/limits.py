@@ -0,0 +1,169 @@
+import json
+import math
+import os
+import threading
+import time
+from typing import Dict, Tuple
+
+from sqlalchemy.pool import QueuePool
+
+from apiserver.core.cache import LRUCache
+
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', 'true').lower() == 'true'
+# requests per second and burst size, per user and worker process
+RATE_LIMITS: Dict[str, Tuple[float, float]] = {
+    'read': (float(os.environ.get('RATE_LIMIT_READ_PER_SECOND', 20)),
+             float(os.environ.get('RATE_LIMIT_READ_BURST', 60))),
+    'write': (float(os.environ.get('RATE_LIMIT_WRITE_PER_SECOND', 10)),
+              float(os.environ.get('RATE_LIMIT_WRITE_BURST', 50))),
+}
+
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get('ADMISSION_MAX_IN_FLIGHT', 64))
+ADMISSION_POOL_WAIT_MS = float(os.environ.get('ADMISSION_POOL_WAIT_MS', 250))
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 1))
+# long-lived, health check or profiling requests (wanted most when a worker is overloaded), never
+# shed and not counted as in flight
+ADMISSION_EXEMPT_PATHS = ('/apiserver/ready', '/apiserver/admin/profile')
+ADMISSION_EXEMPT_SUFFIXES = ('/events',)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self) -> float:
+        """
+        Take a token if one is available.
+
+        :return: 0 if the request may go ahead, otherwise the seconds until a token is available.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+
+            return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    A token bucket per user and route class ('read' or 'write'), so a script ingesting as fast as
+    it can uses up its write budget without eating into anyone's reads.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]], maxsize: int = 4096):
+        self.limits = limits
+        self.buckets = LRUCache(maxsize)
+        self.lock = threading.Lock()
+
+    def take(self, user_id: str, route_class: str) -> float:
+        key = (user_id, route_class)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(*self.limits[route_class])
+                    self.buckets.set(key, bucket)
+
+        return bucket.take()
+
+
+rate_limiter = RateLimiter(RATE_LIMITS)
+
+
+class DecayingAverage:
+    """
+    Exponentially weighted average that also decays towards zero while no samples arrive, so a
+    burst of slow samples can't keep requests shed after the load is gone.
+    """
+
+    def __init__(self, half_life: float = 2.0):
+        self.half_life = half_life
+        self.value = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _decay(self, now: float) -> None:
+        self.value *= math.pow(0.5, (now - self.updated) / self.half_life)
+        self.updated = now
+
+    def add(self, sample: float) -> None:
+        with self.lock:
+            now = time.monotonic()
+            self._decay(now)
+            self.value = 0.8 * self.value + 0.2 * sample
+
+    def get(self) -> float:
+        with self.lock:
+            self._decay(time.monotonic())
+            return self.value
+
+
+# seconds requests wait for a database connection, across the primary and replica pools
+pool_wait = DecayingAverage()
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection in `pool_wait`."""
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_wait.add(time.perf_counter() - started)
+
+
+class AdmissionMiddleware:
+    """
+    Sheds load with 503 and Retry-After before it turns into timeouts: when ADMISSION_MAX_IN_FLIGHT
+    requests are already being handled by this process, or when requests have recently been waiting
+    longer than ADMISSION_POOL_WAIT_MS for a database connection.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.in_flight = 0
+        self.shed = 0
+
+    def overloaded(self) -> str:
+        if self.in_flight >= ADMISSION_MAX_IN_FLIGHT:
+            return 'Too many requests in progress'
+        if pool_wait.get() * 1000 > ADMISSION_POOL_WAIT_MS:
+            return 'Database is overloaded'
+        return ''
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] in ADMISSION_EXEMPT_PATHS \
+                or scope['path'].endswith(ADMISSION_EXEMPT_SUFFIXES):
+            await self.app(scope, receive, send)
+            return
+
+        reason = self.overloaded()
+        if reason:
+            self.shed += 1
+            await send({
+                'type': 'http.response.start',
+                'status': 503,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'retry-after', str(ADMISSION_RETRY_AFTER).encode())],
+            })
+            await send({'type': 'http.response.body', 'body': json.dumps({'detail': reason}).encode()})
+            return
+
+        # the event loop is single-threaded, so the counter needs no lock
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -3,9 +3,20 @@ import time
 from datetime import timedelta
 
 from jose import jwt
-from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+_pwd_context = None
+
+
+def get_pwd_context():
+    """Built on first use, importing passlib and loading bcrypt is only needed for password sign-in."""
+    global _pwd_context
+
+    if _pwd_context is None:
+        from passlib.context import CryptContext
+
+        _pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+    return _pwd_context
 
 
 def create_access_token(data: dict, expires_delta: timedelta):
@@ -20,8 +31,8 @@ def create_access_token(data: dict, expires_delta: timedelta):
 
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
@@ -0,0 +1,59 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs a function at most once at a time per key: callers that arrive while a call for the same
+    key is in progress wait for it and get its result (or exception) instead of running their own.
+    Nothing is kept once the call returns, so the next caller runs it again.
+
+    Callers share the returned object, which must not be modified.
+    """
+
+    def __init__(self):
+        self.calls: Dict[Hashable, _Call] = {}
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.waiters += 1
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+        return call.result
+
+
+def normalize_params(params: Iterable[Tuple[str, Any]]) -> Tuple[Tuple[str, Any], ...]:
+    """Order-independent, hashable form of query parameters, ignoring empty ones."""
+
+    return tuple(sorted((name, value) for name, value in params if value not in (None, '')))
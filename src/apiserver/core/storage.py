@@ -0,0 +1,159 @@
+import base64
+import os
+import tempfile
+import time
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+from apiserver.core.utils import generate_image_sas_url, generate_image_container_sas, get_blob_endpoint
+
+UPLOAD_CHUNK_BYTES = int(os.environ.get('IMAGE_UPLOAD_CHUNK_BYTES', 4 * 1024 * 1024))
+MAX_IMAGE_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 25 * 1024 * 1024))
+
+
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def read_chunks(stream: BinaryIO, chunk_size: int = UPLOAD_CHUNK_BYTES,
+                max_bytes: int = MAX_IMAGE_BYTES) -> Iterator[bytes]:
+    """
+    Yield `stream` in chunks of at most `chunk_size` bytes without reading it into memory at once.
+
+    :raises ImageTooLargeError: once more than `max_bytes` have been read.
+    """
+
+    total = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            return
+        total += len(chunk)
+        if total > max_bytes:
+            raise ImageTooLargeError(f'Image exceeds the {max_bytes} byte limit')
+        yield chunk
+
+
+class AzureImageStore:
+    """
+    Images kept in the IMAGE_CONTAINER blob container. Works against Azurite when
+    STORAGE_BLOB_ENDPOINT points at it.
+    """
+
+    def __init__(self):
+        from azure.storage.blob import BlobServiceClient
+
+        service = BlobServiceClient(
+            account_url=get_blob_endpoint(),
+            credential={
+                'account_name': os.environ['STORAGE_ACCOUNT_NAME'],
+                'account_key': os.environ['STORAGE_ACCOUNT_KEY'],
+            },
+        )
+        self.container = service.get_container_client(os.environ['IMAGE_CONTAINER'])
+        self.container_sas: Optional[Tuple[str, float]] = None
+
+    def upload(self, name: str, stream: BinaryIO, content_type: Optional[str] = None) -> int:
+        """
+        Upload `stream` as a block blob, staging one block per chunk.
+
+        :return: number of bytes written.
+        """
+
+        from azure.storage.blob import BlobBlock, ContentSettings
+
+        blob = self.container.get_blob_client(name)
+        blocks = []
+        size = 0
+        for chunk in read_chunks(stream):
+            block_id = base64.b64encode(f'{len(blocks):08d}'.encode()).decode()
+            blob.stage_block(block_id, chunk)
+            blocks.append(BlobBlock(block_id=block_id))
+            size += len(chunk)
+
+        blob.commit_block_list(blocks, content_settings=ContentSettings(content_type=content_type))
+        return size
+
+    def download(self, name: str) -> bytes:
+        return self.container.get_blob_client(name).download_blob().readall()
+
+    def url(self, name: str) -> str:
+        return generate_image_sas_url(name)
+
+    def url_parts(self) -> Tuple[str, str]:
+        """
+        Prefix and suffix of image URLs, `prefix + name + suffix`, for building them in SQL. Signed
+        with a container SAS that is renewed once half of its 24 hours have passed, so URLs handed
+        out stay valid for at least 12 hours like the per-image ones.
+        """
+
+        if self.container_sas is None or self.container_sas[1] < time.time():
+            self.container_sas = (generate_image_container_sas(), time.time() + 12 * 3600)
+
+        return f"{get_blob_endpoint()}/{os.environ['IMAGE_CONTAINER']}/", f'?{self.container_sas[0]}'
+
+
+class LocalImageStore:
+    """
+    Filesystem stand-in for blob storage, for local development and tests.
+
+    Files are written under IMAGE_STORAGE_DIR and served from IMAGE_BASE_URL.
+    """
+
+    def __init__(self):
+        self.root = os.environ.get('IMAGE_STORAGE_DIR', os.path.join(tempfile.gettempdir(), 'apiserver-images'))
+        self.base_url = os.environ.get('IMAGE_BASE_URL', f'file://{self.root}').rstrip('/')
+
+    def _path(self, name: str) -> str:
+        path = os.path.realpath(os.path.join(self.root, name))
+        if not path.startswith(os.path.realpath(self.root) + os.sep):
+            raise ValueError(f'Invalid image name: {name}')
+        return path
+
+    def upload(self, name: str, stream: BinaryIO, content_type: Optional[str] = None) -> int:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in read_chunks(stream):
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return size
+
+    def download(self, name: str) -> bytes:
+        with open(self._path(name), 'rb') as f:
+            return f.read()
+
+    def url(self, name: str) -> str:
+        return f'{self.base_url}/{name}'
+
+    def url_parts(self) -> Tuple[str, str]:
+        return f'{self.base_url}/', ''
+
+
+_image_store = None
+
+
+def get_image_store():
+    """
+    Image store selected by IMAGE_STORAGE_BACKEND ('azure', the default, or 'local').
+    Created on first use so that importing the app does not require storage credentials.
+    """
+
+    global _image_store
+    if _image_store is None:
+        backend = os.environ.get('IMAGE_STORAGE_BACKEND', 'azure')
+        if backend == 'local':
+            _image_store = LocalImageStore()
+        elif backend == 'azure':
+            _image_store = AzureImageStore()
+        else:
+            raise ValueError(f'Unknown IMAGE_STORAGE_BACKEND: {backend}')
+    return _image_store
@@ -0,0 +1,311 @@
+import asyncio
+import functools
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from starlette.responses import JSONResponse
+
+TRACING_ENABLED = os.environ.get('TRACING_ENABLED', 'false').lower() == 'true'
+# share of requests traced, unless the caller's traceparent says whether to
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+# 'file' appends a JSON line per span to TRACE_FILE, 'otlp' posts OTLP/HTTP JSON to TRACE_OTLP_ENDPOINT
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', 'file')
+TRACE_FILE = os.environ.get('TRACE_FILE', '/tmp/apiserver-traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'wilkins-apiserver')
+# traces waiting for the exporter, more are dropped rather than slowing requests down
+TRACE_QUEUE_SIZE = int(os.environ.get('TRACE_QUEUE_SIZE', 1000))
+# spans kept per trace, e.g. a page of signed image URLs
+TRACE_MAX_SPANS = int(os.environ.get('TRACE_MAX_SPANS', 1000))
+TRACE_SQL_MAX_LENGTH = int(os.environ.get('TRACE_SQL_MAX_LENGTH', 1000))
+
+TRACEPARENT_RE = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+
+def _new_id(bits: int) -> str:
+    return f'{random.getrandbits(bits):0{bits // 4}x}'
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'attributes', 'start', 'end')
+
+    def __init__(self, trace: 'Trace', name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time_ns()
+        self.end: Optional[int] = None
+
+    def child(self, name: str, **attributes) -> 'Span':
+        return self.trace.start(name, self.span_id, attributes)
+
+    def finish(self) -> None:
+        self.end = time.time_ns()
+
+    def to_dict(self) -> dict:
+        return {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'parentSpanId': self.parent_id or '',
+            'name': self.name,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end or self.start),
+            'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in self.attributes.items()],
+        }
+
+
+class Trace:
+    """The spans of one sampled request, exported together once the request is done."""
+
+    def __init__(self, trace_id: Optional[str] = None):
+        self.trace_id = trace_id or _new_id(128)
+        self.spans: List[Span] = []
+        self.dropped = 0
+
+    def start(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]) -> Span:
+        span = Span(self, name, parent_id, attributes)
+        # list.append is atomic, spans are started from the event loop and threadpool threads
+        if len(self.spans) < TRACE_MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+        return span
+
+
+# the innermost open span of the current request, None when the request isn't traced
+current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Times the block as a child of the current span. Does nothing when the request isn't traced."""
+
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+
+    child = parent.child(name, **attributes)
+    token = current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.attributes['error'] = type(e).__name__
+        raise
+    finally:
+        current_span.reset(token)
+        child.finish()
+
+
+def traced(name: str):
+    """Decorator: each call of the function, sync or async, is a span."""
+
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await fn(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def traceparent() -> Optional[str]:
+    """W3C traceparent header for outgoing requests made while handling a traced request."""
+
+    current = current_span.get()
+    if current is None:
+        return None
+    return f'00-{current.trace.trace_id}-{current.span_id}-01'
+
+
+def parse_traceparent(value: Optional[bytes]) -> Optional[Tuple[str, str, bool]]:
+    """(trace id, parent span id, sampled) of a W3C traceparent header, None if missing or invalid."""
+
+    if not value:
+        return None
+    match = TRACEPARENT_RE.match(value.decode('latin-1').strip().lower())
+    if match is None or match[1] == '0' * 32 or match[2] == '0' * 16:
+        return None
+    return match[1], match[2], bool(int(match[3], 16) & 1)
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+class TraceExporter:
+    """
+    Writes finished traces from a background thread, so requests only pay for putting them on a
+    bounded queue. Traces that don't fit are counted in `dropped`.
+    """
+
+    def __init__(self, kind: str = TRACE_EXPORTER):
+        self.kind = kind
+        self.queue: queue.Queue = queue.Queue(TRACE_QUEUE_SIZE)
+        self.dropped = 0
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, name='trace-exporter', daemon=True)
+                    self.thread.start()
+
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            traces = [self.queue.get()]
+            while len(traces) < 100:
+                try:
+                    traces.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            spans = [span.to_dict() for trace in traces for span in trace.spans]
+            try:
+                if self.kind == 'otlp':
+                    self.post(spans)
+                else:
+                    self.write(spans)
+            except Exception as e:
+                print(f'Unable to export {len(traces)} traces: {e}')
+
+    def write(self, spans: List[dict]) -> None:
+        with open(TRACE_FILE, 'a') as f:
+            f.writelines(json.dumps(span) + '\n' for span in spans)
+
+    def post(self, spans: List[dict]) -> None:
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': _otlp_value(TRACE_SERVICE_NAME)}]},
+            'scopeSpans': [{'scope': {'name': 'apiserver'}, 'spans': spans}],
+        }]}
+        httpx.post(TRACE_OTLP_ENDPOINT, json=body, timeout=10).raise_for_status()
+
+
+exporter = TraceExporter()
+
+
+class TracingMiddleware:
+    """
+    Traces a sample of requests: a root span per request, continuing the caller's trace when it
+    sends a traceparent header, and returning the trace's traceparent in the response headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not TRACING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        incoming = parse_traceparent(dict(scope['headers']).get(b'traceparent'))
+        sampled = incoming[2] if incoming is not None else random.random() < TRACE_SAMPLE_RATE
+        if not sampled:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(incoming[0] if incoming is not None else None)
+        root = trace.start(f"{scope['method']} {scope['path']}", incoming[1] if incoming is not None else None,
+                           {'http.method': scope['method'], 'http.target': scope['path']})
+        header = f'00-{trace.trace_id}-{root.span_id}-01'.encode()
+
+        async def send_with_traceparent(message):
+            if message['type'] == 'http.response.start':
+                root.attributes['http.status_code'] = message['status']
+                message['headers'] = list(message.get('headers', [])) + [(b'traceparent', header)]
+            await send(message)
+
+        token = current_span.set(root)
+        try:
+            await self.app(scope, receive, send_with_traceparent)
+        except BaseException as e:
+            root.attributes['error'] = type(e).__name__
+            raise
+        finally:
+            current_span.reset(token)
+            root.finish()
+            route = scope.get('route')
+            if route is not None:
+                root.name = f"{scope['method']} {route.path}"
+                root.attributes['http.route'] = route.path
+            if trace.dropped:
+                root.attributes['spans.dropped'] = trace.dropped
+            exporter.export(trace)
+
+
+class TracedJSONResponse(JSONResponse):
+    """JSONResponse that times rendering the response body."""
+
+    def render(self, content: Any) -> bytes:
+        with span('serialize'):
+            return super().render(content)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    parent = current_span.get()
+    if parent is not None:
+        conn.info.setdefault('trace_spans', []).append(
+            parent.child('sql', **{'db.statement': statement[:TRACE_SQL_MAX_LENGTH], 'db.executemany': executemany}))
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get('trace_spans')
+    if spans:
+        sql_span = spans.pop()
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            sql_span.attributes['db.rowcount'] = cursor.rowcount
+        sql_span.finish()
+
+
+def _handle_error(exception_context):
+    connection = exception_context.connection
+    spans = connection.info.get('trace_spans') if connection is not None else None
+    if spans:
+        sql_span = spans.pop()
+        sql_span.attributes['error'] = type(exception_context.original_exception).__name__
+        sql_span.finish()
+
+
+def instrument_sqlalchemy() -> None:
+    """Time every statement run while a traced request is handled, on all engines."""
+
+    if TRACING_ENABLED and not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
@@ -1,11 +1,12 @@
 import os
 from datetime import datetime, timedelta
 
-from azure.storage.blob import generate_blob_sas, BlobSasPermissions
-
 from dotenv import load_dotenv
 
+from apiserver.core.tracing import traced
+
 
+@traced('storage.sas')
 def generate_image_sas_url(image, expiry_hours=24):
     """
     Generate SAS URLs for all PowerPoint files in the specified container.
@@ -15,6 +16,9 @@ def generate_image_sas_url(image, expiry_hours=24):
     :return: SAS URL.
     """
 
+    # imported here rather than at module level, azure.storage.blob is slow to import
+    from azure.storage.blob import generate_blob_sas, BlobSasPermissions
+
     account_name = os.environ['STORAGE_ACCOUNT_NAME']
     account_key = os.environ['STORAGE_ACCOUNT_KEY']
     container_name = os.environ['IMAGE_CONTAINER']
@@ -27,11 +31,47 @@ def generate_image_sas_url(image, expiry_hours=24):
         permission=BlobSasPermissions(read=True),
         expiry=datetime.utcnow() + timedelta(hours=expiry_hours),
     )
-    image_sas_url = f"https://{account_name}.blob.core.windows.net/{container_name}/{image}?{sas_blob}"
+    image_sas_url = f"{get_blob_endpoint()}/{container_name}/{image}?{sas_blob}"
 
     return image_sas_url
 
 
+@traced('storage.container_sas')
+def generate_image_container_sas(expiry_hours=24) -> str:
+    """
+    Read-only SAS token for the whole image container, for building many image URLs without
+    signing each one.
+
+    :param expiry_hours: The number of hours for which the token will be valid.
+    :return: SAS token (query string without the leading '?').
+    """
+
+    from azure.storage.blob import generate_container_sas, ContainerSasPermissions
+
+    return generate_container_sas(
+        account_name=os.environ['STORAGE_ACCOUNT_NAME'],
+        container_name=os.environ['IMAGE_CONTAINER'],
+        account_key=os.environ['STORAGE_ACCOUNT_KEY'],
+        permission=ContainerSasPermissions(read=True),
+        expiry=datetime.utcnow() + timedelta(hours=expiry_hours),
+    )
+
+
+def get_blob_endpoint() -> str:
+    """
+    Blob service endpoint for the configured storage account.
+
+    Set STORAGE_BLOB_ENDPOINT to point at a local Azurite instance,
+    e.g. http://127.0.0.1:10000/devstoreaccount1.
+    """
+
+    endpoint = os.environ.get('STORAGE_BLOB_ENDPOINT')
+    if endpoint:
+        return endpoint.rstrip('/')
+
+    return f"https://{os.environ['STORAGE_ACCOUNT_NAME']}.blob.core.windows.net"
+
+
 if __name__ == '__main__':
     load_dotenv(verbose=False, dotenv_path='../../../.env.local')
 
@@ -0,0 +1,45 @@
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from apiserver.core.limits import TimedQueuePool
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DATABASE_REPLICA_URL = os.environ.get('DATABASE_REPLICA_URL')
+
+# Shared by the request middleware and the start-up warm-up, so connections opened while warming are
+# the ones requests get from the pool.
+engine = create_engine(
+    os.environ["DATABASE_URL"],
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+)
+
+replica_engine = create_engine(
+    DATABASE_REPLICA_URL,
+    poolclass=TimedQueuePool,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+) if DATABASE_REPLICA_URL else None
+
+
+class RoutingSession(Session):
+    """
+    Sends the statements of a session to the read replica once `session.info['replica']` is set,
+    which the read-only route dependencies do. Flushes and INSERT/UPDATE/DELETE statements always go
+    to the primary, as does everything when no DATABASE_REPLICA_URL is configured.
+    """
+
+    def get_bind(self, mapper=None, clause=None, **kw):
+        if (
+            replica_engine is not None
+            and self.info.get('replica')
+            and not self._flushing
+            and not (clause is not None and getattr(clause, 'is_dml', False))
+        ):
+            return replica_engine
+
+        return super().get_bind(mapper, clause=clause, **kw)
@@ -1,16 +1,41 @@
-import os
+import threading
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse
 from fastapi_sqlalchemy import DBSessionMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
+from apiserver.core.limits import AdmissionMiddleware
+from apiserver.core.tracing import TracingMiddleware, TracedJSONResponse, instrument_sqlalchemy
+from apiserver.db.session import engine, RoutingSession
+from apiserver.routes.admin_route import AdminRouter
+from apiserver.routes.analytics_route import AnalyticsRouter
 from apiserver.routes.auth_route import AuthRouter
+from apiserver.routes.job_route import JobRouter
 from apiserver.routes.project_route import ProjectRouter
+from apiserver.service.events import get_event_broker, stop_event_broker
+from apiserver.service.warmup import warmup
 
 
-app = FastAPI()
-app.add_middleware(DBSessionMiddleware, db_url=os.environ["DATABASE_URL"])
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # warm up in the background so the process starts serving (and reporting not-ready) right away
+    threading.Thread(target=warmup.run, name='warm-up', daemon=True).start()
+    # project versions, which key the coalesced reads, follow the change events
+    get_event_broker().start()
+    yield
+    warmup.stop()
+    stop_event_broker()
+
+
+instrument_sqlalchemy()
+
+app = FastAPI(lifespan=lifespan, default_response_class=TracedJSONResponse)
+app.add_middleware(DBSessionMiddleware, custom_engine=engine, session_args={'class_': RoutingSession})
+# inside CORS, so browsers can read the 503s
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # TODO: only allow origins from frontend in future
@@ -18,6 +43,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"]
 )
+# outermost, so traces include shed requests and the time spent in the other middleware
+app.add_middleware(TracingMiddleware)
 
 auth_router = AuthRouter()
 app.include_router(auth_router.router, prefix='/apiserver')
@@ -25,7 +52,24 @@ app.include_router(auth_router.router, prefix='/apiserver')
 project_router = ProjectRouter()
 app.include_router(project_router.router, prefix='/apiserver')
 
+job_router = JobRouter()
+app.include_router(job_router.router, prefix='/apiserver')
+
+analytics_router = AnalyticsRouter()
+app.include_router(analytics_router.router, prefix='/apiserver')
+
+admin_router = AdminRouter()
+app.include_router(admin_router.router, prefix='/apiserver')
+
 
 @app.get("/apiserver")
 async def root():
     return {"message": "Wilkins Dashboard"}
+
+
+@app.get("/apiserver/ready")
+async def ready():
+    if not warmup.ready.is_set():
+        return JSONResponse(status_code=503, content=warmup.status())
+
+    return warmup.status()
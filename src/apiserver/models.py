@@ -1,8 +1,8 @@
 import enum
 
 from sqlalchemy import Column, Integer, String, ForeignKey, TIMESTAMP, Table, BigInteger, Float, Boolean, Enum, Text, \
-    Date
-from sqlalchemy.dialects.postgresql import JSONB
+    Date, LargeBinary, and_, case, func, literal_column, type_coerce
+from sqlalchemy.dialects.postgresql import JSONB, DATERANGE, Range
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship, column_property
 
@@ -26,6 +26,13 @@ class CostBasisEnum(str, enum.Enum):
     four_week_media_cost = 'Four Week Media Cost'
 
 
+class JobStatusEnum(str, enum.Enum):
+    queued = 'Queued'
+    running = 'Running'
+    succeeded = 'Succeeded'
+    failed = 'Failed'
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -79,6 +86,25 @@ class ProjectVendor(Base):
     vendor = relationship("Vendor")
 
 
+class Job(Base):
+    __tablename__ = "jobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    kind = Column(String(64), nullable=False)
+    status = Column(Enum(JobStatusEnum, name='job_status_enum'), nullable=False, default=JobStatusEnum.queued,
+                    server_default=JobStatusEnum.queued.name)
+    params = Column(JSONB)
+    result = Column(JSONB)
+    error = Column(Text)
+    progress = Column(Float, nullable=False, default=0, server_default='0')
+    attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    created_by = Column(String(256))
+    worker_id = Column(String(256))
+    started_at = Column(TIMESTAMP)
+    heartbeat_at = Column(TIMESTAMP)
+    finished_at = Column(TIMESTAMP)
+
+
 class Submission(Base):
     __tablename__ = "submissions"
 
@@ -137,6 +163,8 @@ class Submission(Base):
     spot_length_secs = Column(Float)
 
     user_locked = Column(Boolean, nullable=False, default=False)
+    # normalize.content_hash of the last ingested version, NULL once edited in the dashboard
+    content_hash = Column(LargeBinary(16))
     selected = Column(Boolean, nullable=False, default=False)
 
     raw_installation_cost = Column(String(32))
@@ -145,6 +173,7 @@ class Submission(Base):
     no_of_periods = Column(Integer)
 
     image_id = Column(String(1024))
+    thumbnail_id = Column(String(1024))
 
     cost_basis = Column(Enum(CostBasisEnum, name='cost_basis_enum'), nullable=False,
                         default=CostBasisEnum.four_week_media_cost, server_default=CostBasisEnum.four_week_media_cost)
@@ -156,6 +185,13 @@ class Submission(Base):
         else:
             return None
 
+    @total_media_cost.expression
+    def total_media_cost(cls):
+        # cost_basis is stored by enum name, so pick the matching media cost column in SQL
+        media_cost = case(*[(cls.cost_basis == cost_basis, getattr(cls, cost_basis.name))
+                            for cost_basis in CostBasisEnum])
+        return cls.no_of_periods * media_cost
+
     @hybrid_property
     def total_cost(self):
         if self.total_media_cost is not None and self.production_cost is not None and self.markup_percentage is not None:
@@ -163,3 +199,84 @@ class Submission(Base):
         else:
             return None
 
+    @total_cost.expression
+    def total_cost(cls):
+        return cls.total_media_cost + cls.production_cost + (cls.markup_percentage * cls.total_media_cost)
+
+    @hybrid_property
+    def cpm(self):
+        if self.total_media_cost is not None and self.a18_weekly_impressions:
+            return self.total_media_cost / self.a18_weekly_impressions * 1000
+        else:
+            return None
+
+    @cpm.expression
+    def cpm(cls):
+        return cls.total_media_cost / func.nullif(cls.a18_weekly_impressions, 0) * 1000
+
+    @hybrid_property
+    def availability(self):
+        if self.availability_start is None and self.availability_end is None:
+            return None
+        if self.availability_start is not None and self.availability_end is not None \
+                and self.availability_start > self.availability_end:
+            return None
+        return Range(self.availability_start, self.availability_end, bounds='[]')
+
+    @availability.expression
+    def availability(cls):
+        # A missing start or end leaves the range open on that side, but a unit without either has no
+        # range, so it doesn't match every window. Rows with start after end get no range rather than
+        # failing the query. The SQL must match ix_submissions_known_availability.
+        availability = func.daterange(cls.availability_start, cls.availability_end, literal_column("'[]'"))
+        unknown = and_(cls.availability_start.is_(None), cls.availability_end.is_(None))
+        return type_coerce(case((cls.availability_start > cls.availability_end, None), (unknown, None),
+                                else_=availability), DATERANGE)
+
+
+class PortfolioRollup(Base):
+    """
+    Submissions pre-aggregated per (project, market, media type, vendor) for the cross-project
+    analytics endpoints. Rebuilt a project at a time by the refresh_portfolio_rollups job.
+    """
+
+    __tablename__ = "portfolio_rollups"
+
+    id = Column(Integer, primary_key=True)
+    project_id = Column(Integer, ForeignKey("projects.id"), nullable=False, index=True)
+    market = Column(String(256))
+    media_type = Column(String(64))
+    vendor_id = Column(Integer, ForeignKey("vendors.id"), nullable=False)
+
+    sites = Column(Integer, nullable=False)
+    selected = Column(Integer, nullable=False)
+    media_cost = Column(Float)
+    # only sites with both a media cost and impressions count towards CPM
+    cpm_media_cost = Column(Float)
+    cpm_impressions = Column(BigInteger)
+    rate_card_count = Column(Integer, nullable=False)
+    rate_card_sum = Column(Float)
+    rate_card_sum_sq = Column(Float)
+    rate_card_min = Column(Float)
+    rate_card_max = Column(Float)
+
+
+class RollupWatermark(Base):
+    __tablename__ = "rollup_watermarks"
+
+    name = Column(String(64), primary_key=True)
+    watermark = Column(TIMESTAMP)
+    refreshed_at = Column(TIMESTAMP)
+
+
+class RecentWrite(Base):
+    """
+    When each user last wrote, shared by all workers to send their reads to the primary for a while
+    after. Unlogged: it isn't replicated or crash-safe, and losing it only sends a few reads to the
+    replica early.
+    """
+
+    __tablename__ = "recent_writes"
+    __table_args__ = {'prefixes': ['UNLOGGED']}
+
+    user_id = Column(String(64), primary_key=True)
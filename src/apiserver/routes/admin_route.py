@@ -0,0 +1,42 @@
+from typing import Any
+
+from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
+
+from apiserver.routes.auth_route import get_admin_user
+from apiserver.schemas import ProfileOut
+from apiserver.service.profiler import profile, ProfileFormat, ProfilerBusyError, PROFILE_MAX_SECONDS
+
+
+class AdminRouter:
+    @property
+    def router(self):
+        api_router = APIRouter(prefix="/admin", tags=["Admin"])
+
+        @api_router.post("/profile", status_code=200, response_model=ProfileOut)
+        async def profile_worker(
+                seconds: float = Query(10, gt=0, le=PROFILE_MAX_SECONDS),
+                interval_ms: float = Query(10, ge=1, le=1000),
+                allocations: int = Query(0, ge=0, le=1000),
+                format: ProfileFormat = Query(ProfileFormat.json),
+                user: dict = Depends(get_admin_user)
+        ) -> Any:
+            """
+            Profile the worker process that handles this request for `seconds`. With `allocations`,
+            the top that many source lines by memory allocated while profiling are included too.
+            The response's `pid` tells which worker was profiled.
+            """
+
+            try:
+                result = await run_in_threadpool(profile, seconds, interval_ms, allocations)
+            except ProfilerBusyError:
+                raise HTTPException(status_code=409, detail="A profile is already running on this worker!")
+
+            if format == ProfileFormat.collapsed:
+                return PlainTextResponse(result['collapsed'], headers={
+                    'Content-Disposition': f'attachment; filename="profile-{result["pid"]}.collapsed"'})
+
+            return result
+
+        return api_router
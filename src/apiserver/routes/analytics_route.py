@@ -0,0 +1,70 @@
+from typing import Any, List
+
+from fastapi import APIRouter, Query, Depends
+from fastapi_sqlalchemy import db
+
+from apiserver.models import ProjectStatusEnum
+from apiserver.routes.auth_route import get_read_user
+from apiserver.schemas import FetchMarketCpmSchema, FetchVendorRatesSchema, FetchWinRatesSchema
+from apiserver.service.analytics import cpm_by_market, vendor_rates, win_rates, get_refreshed_at, WinRateGroup
+
+
+class AnalyticsRouter:
+    """
+    Cross-project analytics served from the portfolio_rollups table, which the job worker refreshes
+    every ROLLUP_REFRESH_INTERVAL seconds. `refreshed_at` tells how current the numbers are.
+    """
+
+    @property
+    def router(self):
+        api_router = APIRouter(prefix="/analytics", tags=["Analytics"])
+
+        @api_router.get("/cpm", status_code=200, response_model=FetchMarketCpmSchema)
+        def fetch_market_cpm(
+                status: List[ProjectStatusEnum] = Query(None),
+                market: str = Query(None),
+                media_type: str = Query(None),
+                min_sites: int = 1,
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+
+            resp = {
+                'data': cpm_by_market(db.session, statuses=status, market=market, media_type=media_type,
+                                      min_sites=min_sites),
+                'refreshed_at': get_refreshed_at(db.session)
+            }
+
+            return resp
+
+        @api_router.get("/vendor-rates", status_code=200, response_model=FetchVendorRatesSchema)
+        def fetch_vendor_rates(
+                status: List[ProjectStatusEnum] = Query(None),
+                market: str = Query(None),
+                media_type: str = Query(None),
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+
+            resp = {
+                'data': vendor_rates(db.session, statuses=status, market=market, media_type=media_type),
+                'refreshed_at': get_refreshed_at(db.session)
+            }
+
+            return resp
+
+        @api_router.get("/win-rates", status_code=200, response_model=FetchWinRatesSchema)
+        def fetch_win_rates(
+                group_by: WinRateGroup = Query(WinRateGroup.vendor),
+                vendor: str = Query(None),
+                market: str = Query(None),
+                media_type: str = Query(None),
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+
+            resp = {
+                'data': win_rates(db.session, group_by=group_by, vendor=vendor, market=market, media_type=media_type),
+                'refreshed_at': get_refreshed_at(db.session)
+            }
+
+            return resp
+
+        return api_router
@@ -1,3 +1,4 @@
+import math
 import os
 import time
 
@@ -12,12 +13,18 @@ from jose.exceptions import JWTClaimsError
 
 from apiserver.models import User
 from apiserver.schemas import UserAuthenticate, SignInResponse, Token
+from apiserver.core.limits import rate_limiter, RATE_LIMIT_ENABLED
 from apiserver.core.security import verify_password, create_access_token
+from apiserver.core.tracing import span, traced, traceparent
+from apiserver.service.read_after_write import record_write, wrote_recently
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="auth/token")
 
 CACHED_PUBLIC_KEYS = {}
 
+# app role (the token's `roles` claim) of Azure users allowed to use the admin endpoints
+AZURE_ADMIN_ROLE = os.environ.get('AZURE_ADMIN_ROLE', 'Admin')
+
 
 class AuthRouter:
     @property
@@ -123,6 +130,7 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> dic
     return user_obj
 
 
+@traced('auth')
 async def get_azure_user(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -133,13 +141,14 @@ async def get_azure_user(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
         kid = get_token_kid(token)
         key = get_public_key(kid)
 
-        payload = jwt.decode(token,
-                             key=key,
-                             algorithms=os.environ['AZURE_ALGORITHM'],
-                             # audience=os.environ['APP_CLIENT_ID'],
-                             # issuer=f'https://login.microsoftonline.com/{os.environ["TENANT_ID"]}/v2.0'
-                             audience=f"api://{os.environ['APP_CLIENT_ID']}",
-                             issuer=f'https://sts.windows.net/{os.environ["TENANT_ID"]}/')
+        with span('auth.verify'):
+            payload = jwt.decode(token,
+                                 key=key,
+                                 algorithms=os.environ['AZURE_ALGORITHM'],
+                                 # audience=os.environ['APP_CLIENT_ID'],
+                                 # issuer=f'https://login.microsoftonline.com/{os.environ["TENANT_ID"]}/v2.0'
+                                 audience=f"api://{os.environ['APP_CLIENT_ID']}",
+                                 issuer=f'https://sts.windows.net/{os.environ["TENANT_ID"]}/')
 
     except JWTClaimsError as e:
         print(f'The token has some invalid claims: {e}')
@@ -170,7 +179,7 @@ async def get_azure_user(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
             'user_id': payload['oid'],
             'name': payload.get('name'),
             'email': payload.get('email'),
-            'is_admin': False,
+            'is_admin': AZURE_ADMIN_ROLE in payload.get('roles', []),
             'is_cli_user': True if payload['appidacr'] == "1" else False
         }
     except Exception:
@@ -181,27 +190,93 @@ async def get_azure_user(token: Annotated[str, Depends(oauth2_scheme)]) -> dict:
     return user_obj
 
 
+def check_rate_limit(user: dict, route_class: str) -> None:
+    if not RATE_LIMIT_ENABLED:
+        return
+
+    retry_after = rate_limiter.take(user['user_id'], route_class)
+    if retry_after:
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS, detail="Too many requests!",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+
+
+def get_read_user(user: dict = Depends(get_azure_user)) -> dict:
+    """
+    get_azure_user for read-only handlers: their queries go to the read replica (when one is
+    configured) unless the user wrote recently through any worker. Counts against the user's read
+    rate limit.
+    """
+
+    check_rate_limit(user, 'read')
+
+    if not wrote_recently(user['user_id']):
+        db.session.info['replica'] = True
+
+    return user
+
+
+def get_write_user(user: dict = Depends(get_azure_user)):
+    """
+    get_azure_user for handlers that write: pins the user's reads to the primary for the next
+    READ_AFTER_WRITE_SECONDS, on every worker. The window is opened before the handler runs, so it
+    is already open when the response arrives, and renewed once the response has been sent. Counts
+    against the user's write rate limit.
+    """
+
+    check_rate_limit(user, 'write')
+    record_write(user['user_id'])
+    yield user
+    record_write(user['user_id'])
+
+
+async def get_admin_user(user: dict = Depends(get_azure_user)) -> dict:
+    """get_azure_user for the admin endpoints, only users with the AZURE_ADMIN_ROLE app role."""
+
+    if not user['is_admin']:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail="You do not have permission to access this resource.")
+
+    return user
+
+
 def get_public_key(kid) -> dict:
     if kid in CACHED_PUBLIC_KEYS:
         return CACHED_PUBLIC_KEYS[kid]
 
     else:
-        tenant_id = os.environ['TENANT_ID']
-        app_client_id = os.environ['APP_CLIENT_ID']
-
         try:
-            response = httpx.get(f'https://login.microsoftonline.com/{tenant_id}/discovery/keys?appid={app_client_id}')
-            response.raise_for_status()
+            fetch_public_keys()
         except Exception:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unable to fetch Public Key",
                                 headers={"WWW-Authenticate": "Bearer"},)
 
-        keys = response.json()
+        return CACHED_PUBLIC_KEYS[kid]
+
 
-        for key in keys['keys']:
-            CACHED_PUBLIC_KEYS[key['kid']] = key
+@traced('auth.jwks')
+def fetch_public_keys() -> int:
+    """
+    Load the tenant's signing keys into CACHED_PUBLIC_KEYS. Called on a cache miss and at start-up,
+    so the first requests after a deploy do not wait on the discovery endpoint.
 
-        return CACHED_PUBLIC_KEYS[kid]
+    :return: number of keys fetched.
+    """
+
+    tenant_id = os.environ['TENANT_ID']
+    app_client_id = os.environ['APP_CLIENT_ID']
+
+    # continues the request's trace in the identity provider's logs, when it is traced
+    trace_header = traceparent()
+    response = httpx.get(f'https://login.microsoftonline.com/{tenant_id}/discovery/keys?appid={app_client_id}',
+                         headers={'traceparent': trace_header} if trace_header else None)
+    response.raise_for_status()
+
+    keys = response.json()
+
+    for key in keys['keys']:
+        CACHED_PUBLIC_KEYS[key['kid']] = key
+
+    return len(keys['keys'])
 
 
 def get_token_kid(token) -> str:
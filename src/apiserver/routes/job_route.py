@@ -0,0 +1,68 @@
+from typing import Any, List
+
+from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi_sqlalchemy import db
+from sqlalchemy import desc
+
+from apiserver.models import Job, JobStatusEnum
+from apiserver.routes.auth_route import get_azure_user
+from apiserver.schemas import JobCreateIn, JobOut, FetchAllJobsSchema
+from apiserver.service.api_crud import job_crud
+from apiserver.service.jobs import JOB_HANDLERS
+
+
+class JobRouter:
+    @property
+    def router(self):
+        api_router = APIRouter(prefix="/jobs", tags=["Jobs"])
+
+        @api_router.post("", status_code=202, response_model=JobOut)
+        def create_job(job_in: JobCreateIn, user: dict = Depends(get_azure_user)) -> Any:
+            if job_in.kind not in JOB_HANDLERS:
+                raise HTTPException(status_code=400, detail=f"Unknown job kind! Expected one of: {', '.join(JOB_HANDLERS)}")
+
+            job_data = {
+                'kind': job_in.kind,
+                'params': job_in.params,
+                'status': JobStatusEnum.queued,
+                'created_by': user['user_id'],
+            }
+
+            return job_crud.create(job_data)
+
+        @api_router.get("", status_code=200, response_model=FetchAllJobsSchema)
+        def fetch_jobs(
+                status: List[JobStatusEnum] = Query(None),
+                kind: str = Query(None),
+                limit: int = 10,
+                skip: int = 0,
+                user: dict = Depends(get_azure_user)
+        ) -> Any:
+
+            query = db.session.query(Job)
+            if status:
+                query = query.filter(Job.status.in_(status))
+            if kind:
+                query = query.filter(Job.kind == kind)
+
+            total_records = query.count()
+            query = query.order_by(desc(Job.id))
+            query = query.limit(limit).offset(skip)
+
+            resp = {
+                'data': query.all(),
+                'total_records': total_records
+            }
+
+            return resp
+
+        @api_router.get("/{job_id}", status_code=200, response_model=JobOut)
+        def fetch_job(job_id: int, user: dict = Depends(get_azure_user)) -> Any:
+            job = job_crud.get(job_id)
+
+            if job is None:
+                raise HTTPException(status_code=404, detail="Job not found!")
+
+            return job
+
+        return api_router
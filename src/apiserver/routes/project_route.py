@@ -1,22 +1,56 @@
+import functools
+import os
+from datetime import date
 from enum import Enum
-from typing import List, Any
+from typing import List, Any, Dict, Callable
 
-from fastapi.encoders import jsonable_encoder
-from sqlalchemy import or_, desc, update, func
+from sqlalchemy import or_, desc, update, func, select, literal, literal_column, text
+from sqlalchemy.dialects.postgresql import Range, aggregate_order_by
 from fastapi_sqlalchemy import db
-from fastapi import APIRouter, Query, Depends, HTTPException
+from fastapi import APIRouter, Query, Depends, HTTPException, UploadFile, Header, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, FileResponse
 
 from apiserver.core.security import get_password_hash
-from apiserver.core.utils import generate_image_sas_url
-from apiserver.routes.auth_route import get_azure_user
+from apiserver.core.singleflight import SingleFlight, normalize_params
+from apiserver.core.storage import get_image_store, ImageTooLargeError
+from apiserver.routes.auth_route import get_read_user, get_write_user
 from apiserver.service.api_crud import project_crud, submission_crud, vendor_crud, project_vendor_crud, user_crud, \
     user_project_crud
-from apiserver.models import Project, ProjectStatusEnum, Submission, Vendor, ProjectVendor, User, UserProject
+from apiserver.service.autocomplete import autocomplete
+from apiserver.service.duplicates import find_possible_duplicates, project_duplicate_groups, \
+    DUPLICATE_DISTANCE_METERS
+from apiserver.service.events import notify_project_event, get_event_broker, stream_project_events
+from apiserver.service.identity_cache import identity_cache
+from apiserver.service.json_pages import json_page, enum_value, DB_RENDERED_JSON
+from apiserver.service.normalize import normalize_submission, content_hash
+from apiserver.service.snapshots import get_snapshot, SnapshotFormat, MEDIA_TYPES
+from apiserver.service.images import store_image, generate_missing_thumbnails, InvalidImageError
+from apiserver.models import Project, ProjectStatusEnum, CostBasisEnum, Submission, Vendor, ProjectVendor, User, \
+    UserProject
 from apiserver.schemas import ProjectCreateIn, FetchAllProjectsSchema, \
     ProjectSubmissionsSchema, ProjectOut, SubmissionCreateIn, \
     SubmissionCreateOut, VendorCreateRequestSchema, UserCreateRequestSchema, UserCreateResponseSchema, \
     VendorCreateResponseSchema, SubmissionUpdateIn, SubmissionUpdateOut, ProjectStats, ProjectUpdateIn, \
-    SelectedSubmissionIn, SelectedSubmissionOut
+    SelectedSubmissionIn, SelectedSubmissionOut, SubmissionImageOut, ThumbnailBackfillOut, SubmissionBatchUpdateIn, \
+    SubmissionBatchUpdateOut, FetchDuplicatesSchema, SubmissionBulkOut, SubmissionFilter, AvailabilityMatch, \
+    IngestResult
+
+
+SUBMISSION_BATCH_LIMIT = int(os.environ.get('SUBMISSION_BATCH_LIMIT', 1000))
+SUBMISSION_BULK_LIMIT = int(os.environ.get('SUBMISSION_BULK_LIMIT', 10000))
+
+# columns of a submissions listing row, besides vendor and the image URLs
+SUBMISSION_PAGE_COLUMNS = [
+    'unit_id', 'unit', 'town', 'state', 'market', 'location_description', 'geopath_id', 'target_location',
+    'a18_weekly_impressions', 'a18_4wk_reach', 'a18_4wk_freq', 'availability_start', 'availability_end',
+    'total_units', 'installation_cost', 'markup_percentage', 'is_prod_forced', 'taxes', 'four_week_rate_card',
+    'internal_four_week_media_cost', 'additional_installation_cost', 'unit_highlights', 'no_of_spots_per_loop',
+    'spot_length_secs', 'distance_to_location', 'media_type', 'facing', 'is_illuminated', 'one_week_media_cost',
+    'two_week_media_cost', 'three_week_media_cost', 'four_week_media_cost', 'initial_installation_cost',
+    'production_cost', 'latitude', 'longitude', 'selected', 'size', 'no_of_periods', 'total_media_cost',
+    'total_cost', 'cpm', 'image_id', 'raw_installation_cost', 'raw_date',
+]
 
 
 class SortOrder(str, Enum):
@@ -24,6 +58,98 @@ class SortOrder(str, Enum):
     desc = "desc"
 
 
+# identical reads of the same project that run at the same time share one query
+read_flight = SingleFlight()
+
+
+def coalesce_reads(when: Callable[[dict], bool] = None):
+    """
+    Handler decorator: concurrent calls with the same arguments for the same version of the project
+    share one execution. Users who wrote recently (whose reads aren't sent to the replica) always
+    run their own, so they see their changes.
+    """
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(**kwargs):
+            if not db.session.info.get('replica') or (when is not None and not when(kwargs)):
+                return handler(**kwargs)
+
+            project_id = identity_cache.get_project_id(kwargs['wilkins_id'])
+            params = normalize_params((name, value) for name, value in kwargs.items() if name != 'user')
+            key = (handler.__name__, get_event_broker().version(project_id), params)
+
+            return read_flight.do(key, lambda: handler(**kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+def submission_criteria(filters: SubmissionFilter) -> list:
+    """
+    WHERE criteria of the submissions matching `filters`, for the listing and for selecting by
+    filter. Vendor names are matched with EXISTS subqueries, so the criteria also work in an UPDATE.
+    """
+
+    criteria = []
+    if filters.state:
+        criteria.append(Submission.state == filters.state)
+    if filters.town:
+        criteria.append(Submission.town == filters.town)
+    if filters.media_type:
+        criteria.append(Submission.media_type == filters.media_type)
+    if filters.vendor:
+        criteria.append(Submission.vendor.has(Vendor.name == filters.vendor))
+    if filters.illuminated is not None:
+        criteria.append(Submission.is_illuminated.is_(filters.illuminated))
+    if filters.selected is not None:
+        criteria.append(Submission.selected.is_(filters.selected))
+    if filters.min_media_cost is not None:
+        criteria.append(Submission.total_media_cost >= filters.min_media_cost)
+    if filters.max_media_cost is not None:
+        criteria.append(Submission.total_media_cost <= filters.max_media_cost)
+    if filters.min_cpm is not None:
+        criteria.append(Submission.cpm >= filters.min_cpm)
+    if filters.max_cpm is not None:
+        criteria.append(Submission.cpm <= filters.max_cpm)
+
+    # compared as date ranges in SQL, so the filters can use ix_submissions_known_availability
+    available = Submission.availability
+    if filters.available_from is not None or filters.available_to is not None:
+        if filters.available_from is None or filters.available_to is None:
+            raise HTTPException(status_code=400, detail='Both available_from and available_to are required!')
+        if filters.available_from > filters.available_to:
+            raise HTTPException(status_code=400, detail='available_from must not be after available_to!')
+
+        window = Range(filters.available_from, filters.available_to, bounds='[]')
+        if filters.availability == AvailabilityMatch.contains:
+            criteria.append(available.contains(window))
+        else:
+            criteria.append(available.overlaps(window))
+        # only the part of the availability inside the window counts towards min_weeks
+        available = available.intersection(window)
+
+    if filters.min_weeks is not None:
+        # daterange is canonicalized to [start, end + 1), so upper - lower is the number of days
+        criteria.append(or_(func.lower_inf(available), func.upper_inf(available),
+                            func.upper(available) - func.lower(available) >= filters.min_weeks * 7))
+
+    if filters.search:
+        search = filters.search
+        criteria.append(or_(
+            Submission.vendor.has(Vendor.name.ilike(f'%%{search}%%')),
+            Submission.unit_id.ilike(f'%%{search}%%'),
+            Submission.town.ilike(f'%%{search}%%'),
+            Submission.market.ilike(f'%%{search}%%'),
+            Submission.state.ilike(f'%%{search}%%'),
+            Submission.media_type.ilike(f'%%{search}%%'),
+            Submission.facing.ilike(f'{search}%%'),
+        ))
+
+    return criteria
+
+
 class ProjectRouter:
     @property
     def router(self):
@@ -37,24 +163,40 @@ class ProjectRouter:
                 search: str = Query(None),
                 limit: int = 10,
                 skip: int = 0,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
+            # vendors are matched with EXISTS, joining them would repeat projects with several matching vendors
             query = db.session.query(Project)
-            if vendor or search:
-                query = query.outerjoin(Project.project_vendors)
-                query = query.outerjoin(ProjectVendor.vendor)
             if status:
                 query = query.filter(Project.status.in_(status))
             if client:
                 query = query.filter(Project.client == client)
             if vendor:
-                query = query.filter(Vendor.name == vendor)
+                query = query.filter(Project.project_vendors.any(ProjectVendor.vendor.has(Vendor.name == vendor)))
             if search:
                 query = query.filter(or_(Project.wilkins_id.ilike(f'%%{search}%%'),
                                          Project.name.ilike(f'%%{search}%%'),
                                          Project.client.ilike(f'%%{search}%%'),
-                                         Vendor.name.ilike(f'%%{search}%%')))
+                                         Project.project_vendors.any(
+                                             ProjectVendor.vendor.has(Vendor.name.ilike(f'%%{search}%%')))))
+
+            if DB_RENDERED_JSON:
+                vendor_names = select(func.coalesce(
+                    func.json_agg(aggregate_order_by(Vendor.name, ProjectVendor.id)), text("'[]'::json")))
+                vendor_names = vendor_names.join_from(ProjectVendor, Vendor, Vendor.id == ProjectVendor.vendor_id)
+                vendor_names = vendor_names.where(ProjectVendor.project_id == Project.id).scalar_subquery()
+
+                fields = {
+                    'wilkins_id': Project.wilkins_id,
+                    'name': Project.name,
+                    'client': Project.client,
+                    'status': enum_value(Project.status, ProjectStatusEnum),
+                    'budget': Project.budget,
+                    'vendors': vendor_names,
+                }
+                return Response(json_page(query, fields, limit, skip, order_by=[desc(Project.created_at)]),
+                                media_type='application/json')
 
             total_records = query.count()
             query = query.order_by(desc(Project.created_at))
@@ -81,23 +223,35 @@ class ProjectRouter:
             return resp
 
         @api_router.post("", status_code=201, response_model=ProjectOut)
-        def create_project(project_in: ProjectCreateIn, user: dict = Depends(get_azure_user)) -> Any:
-            return project_crud.create(obj_in=project_in)
+        def create_project(project_in: ProjectCreateIn, user: dict = Depends(get_write_user)) -> Any:
+            project = project_crud.create(obj_in=project_in, returning=project_crud.columns_for(ProjectOut, 'id'))
+            identity_cache.set_project_id(project.wilkins_id, project.id)
+            autocomplete.add_client(project.client)
+
+            return project
 
         @api_router.put("/{wilkins_id}", status_code=200, response_model=ProjectOut)
         def update_project(
                 wilkins_id: str,
                 project_update: ProjectUpdateIn,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_write_user)
         ) -> Any:
 
-            project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
-            if project is None:
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
                 raise HTTPException(404, 'Project not found!')
 
-            return project_crud.update(db_obj=project, obj_in=project_update)
+            identity_cache.invalidate_project(wilkins_id)
+            notify_project_event(db.session, project_id, 'project_updated')
+
+            project = project_crud.update(id=project_id, obj_in=project_update,
+                                          returning=project_crud.columns_for(ProjectOut))
+            autocomplete.add_client(project.client)
+
+            return project
 
         @api_router.get("/{wilkins_id}/submissions", status_code=200, response_model=ProjectSubmissionsSchema)
+        @coalesce_reads(when=lambda kwargs: kwargs['skip'] == 0)
         def fetch_project_submissions(
                 wilkins_id: str,
                 state: str = Query(None),
@@ -106,48 +260,52 @@ class ProjectRouter:
                 vendor: str = Query(None),
                 illuminated: bool = Query(None),
                 selected: bool = Query(None),
+                min_media_cost: float = Query(None),
+                max_media_cost: float = Query(None),
+                min_cpm: float = Query(None),
+                max_cpm: float = Query(None),
+                available_from: date = Query(None),
+                available_to: date = Query(None),
+                availability: AvailabilityMatch = AvailabilityMatch.contains,
+                min_weeks: int = Query(None, ge=1),
                 sort_column: str = Query(None),
                 sort_order: SortOrder = Query(None),
                 search: str = Query(None),
                 limit: int = 10,
                 skip: int = 0,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
-            project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
-            if project is None:
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
                 raise HTTPException(status_code=400, detail='Project not found!')
 
-            query = db.session.query(Submission)
-            query = query.join(Submission.project)
-            query = query.filter(Project.wilkins_id == wilkins_id)
-
-            if vendor or search:
-                query = query.join(Submission.vendor)
-
-            if state:
-                query = query.filter(Submission.state == state)
-            if town:
-                query = query.filter(Submission.town == town)
-            if media_type:
-                query = query.filter(Submission.media_type == media_type)
-            if vendor:
-                query = query.filter(Vendor.name == vendor)
-            if illuminated is not None:
-                query = query.filter(Submission.is_illuminated.is_(illuminated))
-            if selected is not None:
-                query = query.filter(Submission.selected.is_(selected))
+            filters = SubmissionFilter(state=state, town=town, media_type=media_type, vendor=vendor,
+                                       illuminated=illuminated, selected=selected, min_media_cost=min_media_cost,
+                                       max_media_cost=max_media_cost, min_cpm=min_cpm, max_cpm=max_cpm,
+                                       available_from=available_from, available_to=available_to,
+                                       availability=availability, min_weeks=min_weeks, search=search)
 
-            if search:
-                query = query.filter(or_(
-                    Vendor.name.ilike(f'%%{search}%%'),
-                    Submission.unit_id.ilike(f'%%{search}%%'),
-                    Submission.town.ilike(f'%%{search}%%'),
-                    Submission.market.ilike(f'%%{search}%%'),
-                    Submission.state.ilike(f'%%{search}%%'),
-                    Submission.media_type.ilike(f'%%{search}%%'),
-                    Submission.facing.ilike(f'{search}%%'),
-                ))
+            query = db.session.query(Submission)
+            query = query.filter(Submission.project_id == project_id, *submission_criteria(filters))
+
+            image_store = get_image_store()
+
+            if DB_RENDERED_JSON:
+                # image URLs signed with one container SAS, as a per-image signature can't be made in SQL
+                url_prefix, url_suffix = image_store.url_parts()
+                vendor_name = select(Vendor.name).where(Vendor.id == Submission.vendor_id).scalar_subquery()
+                fields = {
+                    'vendor': vendor_name,
+                    **{column: getattr(Submission, column) for column in SUBMISSION_PAGE_COLUMNS},
+                    'cost_basis': enum_value(Submission.cost_basis, CostBasisEnum),
+                    # NULL when there is no image
+                    'image_url': literal(url_prefix) + Submission.image_id + literal(url_suffix),
+                    'thumbnail_url': literal(url_prefix) + Submission.thumbnail_id + literal(url_suffix),
+                }
+                order_by = [getattr(getattr(Submission, sort_column), sort_order)()] if sort_column else []
+                return Response(json_page(query, fields, limit, skip, order_by=order_by),
+                                media_type='application/json')
 
             total_records = query.count()
 
@@ -202,8 +360,15 @@ class ProjectRouter:
                     'selected': rec.selected,
                     'size': rec.size,
                     'no_of_periods': rec.no_of_periods,
+                    'total_media_cost': rec.total_media_cost,
+                    'total_cost': rec.total_cost,
+                    'cpm': rec.cpm,
                     'image_id': rec.image_id,
-                    'image_url': generate_image_sas_url(rec.image_id) if rec.image_id is not None else None,
+                    'raw_installation_cost': rec.raw_installation_cost,
+                    'raw_date': rec.raw_date,
+                    'cost_basis': rec.cost_basis,
+                    'image_url': image_store.url(rec.image_id) if rec.image_id is not None else None,
+                    'thumbnail_url': image_store.url(rec.thumbnail_id) if rec.thumbnail_id is not None else None,
                 })
 
             resp = {
@@ -217,160 +382,385 @@ class ProjectRouter:
         def create_submission(
                 wilkins_id: str,
                 submission_in: SubmissionCreateIn,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_write_user)
         ) -> Any:
 
-            submission = db.session.query(Submission).filter(Submission.unit_id == submission_in.unit_id).first()
+            submission_in = submission_in.model_copy(update=normalize_submission(submission_in.model_dump()))
+            submission_hash = content_hash(submission_in.model_dump(exclude_unset=True, exclude={'vendor_email'}))
+
+            query = db.session.query(Submission.id, Submission.user_locked, Submission.project_id,
+                                     Submission.content_hash)
+            submission = query.filter(Submission.unit_id == submission_in.unit_id).first()
 
             if submission is None:
-                vendor = db.session.query(Vendor).filter(Vendor.name == submission_in.vendor).first()
+                project_id = identity_cache.get_project_id(wilkins_id)
+                if project_id is None:
+                    raise HTTPException(status_code=404, detail="Project not found!")
 
-                if vendor is None:
+                vendor_id = identity_cache.get_vendor_id(submission_in.vendor)
+
+                if vendor_id is None:
                     vendor_data = {
                         'name': submission_in.vendor,
                         'emails': [submission_in.vendor_email] if submission_in.vendor_email is not None else []
                     }
-                    vendor = vendor_crud.create(vendor_data)
-
-                project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
-                if project is None:
-                    raise HTTPException(status_code=404, detail="Project not found!")
-
-                query = db.session.query(ProjectVendor)
-                query = query.filter(ProjectVendor.project_id == project.id,
-                                     ProjectVendor.vendor_id == vendor.id)
-                project_vendor = query.first()
+                    vendor_id = vendor_crud.create(vendor_data, returning=[Vendor.id]).id
+                    identity_cache.set_vendor_id(submission_in.vendor, vendor_id)
+                    autocomplete.add_vendor(submission_in.vendor)
 
-                if project_vendor is None:
+                if not identity_cache.project_vendor_exists(project_id, vendor_id):
                     project_vendor_in = {
-                        'vendor_id': vendor.id,
-                        'project_id': project.id,
+                        'vendor_id': vendor_id,
+                        'project_id': project_id,
                     }
-                    project_vendor_crud.create(project_vendor_in)
-
-                submission_in_dict = jsonable_encoder(submission_in)
-                submission_in_dict.pop('vendor_email')
-                submission_in_dict.pop('vendor')
-                submission_in_dict['project_id'] = project.id
-                submission_in_dict['vendor_id'] = vendor.id
-                return submission_crud.create(obj_in=submission_in_dict)
+                    project_vendor_crud.create(project_vendor_in, returning=[ProjectVendor.id])
+                    identity_cache.add_project_vendor(project_id, vendor_id)
+
+                submission_in_dict = submission_in.model_dump(exclude={'vendor', 'vendor_email'})
+                submission_in_dict['project_id'] = project_id
+                submission_in_dict['vendor_id'] = vendor_id
+                submission_in_dict['content_hash'] = submission_hash
+                notify_project_event(db.session, project_id, 'submission_upserted', [submission_in.unit_id])
+                created = submission_crud.create(obj_in=submission_in_dict,
+                                                 returning=submission_crud.columns_for(SubmissionCreateOut))
+                resp = submission_crud.with_vendor(created, submission_in.vendor)
+                resp['ingest_result'] = IngestResult.created
 
             else:
                 if submission.user_locked and user['is_cli_user']:
                     raise HTTPException(status_code=403, detail="You do not have permission to access this resource.")
 
-                return submission_crud.update(db_obj=submission, obj_in=submission_in)
+                project_id = submission.project_id
+                columns = submission_crud.columns_with_vendor(SubmissionCreateOut)
+                if submission.content_hash == submission_hash:
+                    # re-posted as it was, writing it would only bump updated_at
+                    unchanged = db.session.execute(select(*columns).where(Submission.id == submission.id)).one()
+                    resp = submission_crud.with_vendor(unchanged)
+                    resp['ingest_result'] = IngestResult.unchanged
+                else:
+                    notify_project_event(db.session, project_id, 'submission_upserted', [submission_in.unit_id])
+                    updated = submission_crud.update(
+                        id=submission.id, returning=columns,
+                        obj_in={**submission_in.model_dump(exclude_unset=True), 'content_hash': submission_hash})
+                    resp = submission_crud.with_vendor(updated)
+                    resp['ingest_result'] = IngestResult.updated
+
+            autocomplete.add_submissions(project_id, [resp])
+            resp['possible_duplicates'] = find_possible_duplicates(db.session, project_id, resp['unit_id'],
+                                                                   resp['geopath_id'], resp['latitude'],
+                                                                   resp['longitude'])
+
+            return resp
+
+        @api_router.post("/{wilkins_id}/submissions/bulk", status_code=200, response_model=SubmissionBulkOut)
+        def create_submissions(
+                wilkins_id: str,
+                submissions_in: List[SubmissionCreateIn],
+                user: dict = Depends(get_write_user)
+        ) -> Any:
+            """
+            Create or update a whole sheet of submissions in one transaction. Raw cost and date fields are
+            parsed like for single submissions. Submissions locked by a planner (for the CLI) or belonging
+            to another project are left alone and listed as skipped. Submissions sent exactly as they were
+            last ingested are not written at all. Later rows win over earlier rows with the same unit_id.
+            """
+
+            if len(submissions_in) > SUBMISSION_BULK_LIMIT:
+                raise HTTPException(status_code=400,
+                                    detail=f"At most {SUBMISSION_BULK_LIMIT} submissions can be sent at once!")
+
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
+
+            if not submissions_in:
+                return {'upserted': 0, 'created': 0, 'updated': 0, 'unchanged': 0, 'skipped': []}
+
+            vendor_emails: Dict[str, set] = {}
+            for submission_in in submissions_in:
+                emails = vendor_emails.setdefault(submission_in.vendor, set())
+                if submission_in.vendor_email is not None:
+                    emails.add(submission_in.vendor_email)
+
+            vendor_ids = {name: identity_cache.get_vendor_id(name) for name in vendor_emails}
+            new_vendors = [{'name': name, 'emails': sorted(vendor_emails[name])}
+                           for name, vendor_id in vendor_ids.items() if vendor_id is None]
+            if new_vendors:
+                # a vendor created concurrently by another request is picked up by the no-op update
+                created = vendor_crud.upsert_many(new_vendors, index_elements=['name'], update_columns=['name'],
+                                                  returning=[Vendor.id, Vendor.name], commit=False)
+                for vendor in created:
+                    vendor_ids[vendor.name] = vendor.id
+
+            new_project_vendors = [{'project_id': project_id, 'vendor_id': vendor_id}
+                                   for vendor_id in set(vendor_ids.values())
+                                   if not identity_cache.project_vendor_exists(project_id, vendor_id)]
+            project_vendor_crud.create_many(new_project_vendors, returning=[ProjectVendor.id], commit=False)
+
+            rows = {}
+            for submission_in in submissions_in:
+                row = submission_in.model_dump(exclude={'vendor', 'vendor_email'})
+                row['project_id'] = project_id
+                row['vendor_id'] = vendor_ids[submission_in.vendor]
+                # like single submissions, existing ones only get the fields that were sent (or parsed)
+                row_columns = submission_in.model_fields_set - {'unit_id', 'vendor', 'vendor_email'}
+                rows[submission_in.unit_id] = (row, row_columns | {'vendor_id', 'content_hash'}, submission_in)
+
+            query = db.session.query(Submission.unit_id, Submission.content_hash)
+            query = query.filter(Submission.unit_id.in_(rows.keys()), Submission.project_id == project_id)
+            stored_hashes = dict(query.all())
+
+            where = (Submission.project_id == project_id) & \
+                Submission.content_hash.is_distinct_from(submission_crud.excluded('content_hash'))
+            if user['is_cli_user']:
+                where = where & Submission.user_locked.is_(False)
+
+            # one statement per set of updated columns, a sheet usually has a single one
+            groups: Dict[frozenset, List[dict]] = {}
+            unchanged = []
+            today = date.today()
+            for row, row_columns, submission_in in rows.values():
+                parsed = normalize_submission(row, today)
+                row.update(parsed)
+                row_columns |= parsed.keys()
+                # the same digest as for single submissions
+                row['content_hash'] = content_hash({**submission_in.model_dump(exclude_unset=True,
+                                                                               exclude={'vendor_email'}), **parsed})
+                if stored_hashes.get(row['unit_id']) == row['content_hash']:
+                    unchanged.append(row['unit_id'])
+                    continue
+                groups.setdefault(frozenset(row_columns), []).append(row)
+
+            # xmax is 0 for rows the INSERT created, and the updating transaction's id for updated ones
+            returning = [Submission.unit_id, (literal_column('xmax') == 0).label('created')]
+            upserted = []
+            for update_columns, group in groups.items():
+                upserted += submission_crud.upsert_many(group, index_elements=['unit_id'],
+                                                        update_columns=sorted(update_columns), where=where,
+                                                        returning=returning, commit=False)
+            created = sum(1 for row in upserted if row.created)
+            upserted = [row.unit_id for row in upserted]
+
+            if upserted:
+                notify_project_event(db.session, project_id, 'submission_upserted', upserted)
+            db.session.commit()
+
+            for name, vendor_id in vendor_ids.items():
+                identity_cache.set_vendor_id(name, vendor_id)
+            for project_vendor in new_project_vendors:
+                identity_cache.add_project_vendor(project_id, project_vendor['vendor_id'])
+            for vendor in new_vendors:
+                autocomplete.add_vendor(vendor['name'])
+            upserted_rows = set(upserted)
+            autocomplete.add_submissions(project_id, (row for row, _, _ in rows.values()
+                                                      if row['unit_id'] in upserted_rows))
+
+            return {
+                'upserted': len(upserted),
+                'created': created,
+                'updated': len(upserted) - created,
+                'unchanged': len(unchanged),
+                'skipped': sorted(rows.keys() - upserted_rows - set(unchanged)),
+            }
 
         @api_router.patch("/{wilkins_id}/submissions/{unit_id}", status_code=200, response_model=SubmissionUpdateOut)
         def update_submission(
                 wilkins_id: str,
                 unit_id: str,
                 submission_update: SubmissionUpdateIn,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_write_user)
         ) -> Any:
 
-            submission = db.session.query(Submission).filter(Submission.unit_id == unit_id).first()
+            query = db.session.query(Submission.id, Submission.user_locked, Submission.project_id)
+            submission = query.filter(Submission.unit_id == unit_id).first()
 
             if submission is None:
                 raise HTTPException(status_code=404, detail="Submission not found!")
 
             submission_update = submission_update.model_dump(exclude_unset=True)
+            notify_project_event(db.session, submission.project_id, 'submission_edited', [unit_id],
+                                 fields=sorted(submission_update))
 
             if not submission.user_locked:
                 submission_update['user_locked'] = True
+            # edited by hand, so the next ingest of the unit is never skipped as unchanged
+            submission_update['content_hash'] = None
 
-            return submission_crud.update(db_obj=submission, obj_in=submission_update)
+            project_id = submission.project_id
+            submission = submission_crud.update(id=submission.id, obj_in=submission_update,
+                                                returning=submission_crud.columns_with_vendor(SubmissionUpdateOut))
+            resp = submission_crud.with_vendor(submission)
+            autocomplete.add_submissions(project_id, [resp])
 
-        @api_router.get("/clients", status_code=200, response_model=List[str])
-        def fetch_project_clients(search: str = Query(None), user: dict = Depends(get_azure_user)) -> Any:
+            return resp
 
-            query = db.session.query(Project.client)
-            query = query.filter(Project.client.isnot(None))
-            if search:
-                query = query.filter(Project.client.ilike(f'%%{search}%%'))
+        @api_router.patch("/{wilkins_id}/submissions", status_code=200, response_model=SubmissionBatchUpdateOut)
+        def update_submissions(
+                wilkins_id: str,
+                submission_updates: List[SubmissionBatchUpdateIn],
+                user: dict = Depends(get_write_user)
+        ) -> Any:
 
-            query = query.distinct()
-            query = query.limit(10)
-            records = query.all()
+            if len(submission_updates) > SUBMISSION_BATCH_LIMIT:
+                raise HTTPException(status_code=400,
+                                    detail=f"At most {SUBMISSION_BATCH_LIMIT} changes can be applied at once!")
 
-            resp = [rec.client for rec in records]
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
 
-            return resp
+            # several cells of the same row arrive as separate items, later ones win
+            changes: Dict[str, Dict[str, Any]] = {}
+            for submission_update in submission_updates:
+                row_changes = changes.setdefault(submission_update.unit_id, {})
+                row_changes.update(submission_update.changes.model_dump(exclude_unset=True))
 
-        @api_router.get("/vendors", status_code=200, response_model=List[str])
-        def fetch_project_vendors(
-                search: str = Query(None),
-                user: dict = Depends(get_azure_user)
-        ) -> Any:
+            if not changes:
+                return {'updated': 0}
 
-            query = db.session.query(Vendor.name)
+            updated = submission_crud.update_many(changes, key='unit_id', where=[Submission.project_id == project_id],
+                                                  extra_values={'user_locked': True, 'content_hash': None},
+                                                  commit=False)
+            updated = [row.unit_id for row in updated]
 
-            if search:
-                query = query.filter(Vendor.name.ilike(f'%%{search}%%'))
+            missing = changes.keys() - set(updated)
+            if missing:
+                db.session.rollback()
+                raise HTTPException(status_code=404, detail=f"Submissions not found: {', '.join(sorted(missing))}")
 
-            query = query.limit(10)
-            records = query.all()
+            notify_project_event(db.session, project_id, 'submission_edited', updated)
+            db.session.commit()
 
-            resp = [rec.name for rec in records]
+            # a town changed without its state is only tagged with the state once the index is rebuilt
+            autocomplete.add_submissions(project_id, changes.values())
 
-            return resp
+            return {'updated': len(updated)}
 
-        @api_router.put("/{wilkins_id}/select-submissions", status_code=200, response_model=SelectedSubmissionOut)
-        def select_submissions(
+        @api_router.put("/{wilkins_id}/submissions/{unit_id}/image", status_code=200,
+                        response_model=SubmissionImageOut)
+        def upload_submission_image(
                 wilkins_id: str,
-                selected_submissions: SelectedSubmissionIn,
-                user: dict = Depends(get_azure_user)
+                unit_id: str,
+                file: UploadFile,
+                user: dict = Depends(get_write_user)
         ) -> Any:
-            project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
-            if project is None:
-                raise HTTPException(status_code=400, detail='Project not found!')
 
-            stmt = update(Submission).where(Submission.unit_id.in_(selected_submissions.unit_ids)).values(selected=selected_submissions.selected)
-            db.session.execute(stmt)
-            db.session.commit()
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
 
-            query = db.session.query(func.sum(Submission.a18_weekly_impressions).label('impressions'),
-                                     func.count(Submission.id).label('selected'))
-            query = query.filter(Submission.project_id == project.id)
-            query = query.filter(Submission.selected.is_(True))
-            result = query.one_or_none()
+            query = db.session.query(Submission.id, Submission.user_locked)
+            query = query.filter(Submission.project_id == project_id, Submission.unit_id == unit_id)
+            submission = query.first()
 
-            query = db.session.query(Submission)
-            query = query.filter(Submission.project_id == project.id)
-            query = query.filter(Submission.selected.is_(True))
-            submissions = query.all()
+            if submission is None:
+                raise HTTPException(status_code=404, detail="Submission not found!")
 
-            total_media_cost = sum(rec.total_media_cost for rec in submissions if rec.total_media_cost is not None)
-            # total_cost = sum(rec.total_cost for rec in submissions if rec.total_cost is not None)
+            if submission.user_locked and user['is_cli_user']:
+                raise HTTPException(status_code=403, detail="You do not have permission to access this resource.")
 
-            if result.impressions is not None and result.impressions > 0:
-                cpm = total_media_cost / result.impressions * 1000
-            else:
-                cpm = 0
+            if not (file.content_type or '').startswith('image/'):
+                raise HTTPException(status_code=400, detail="Only image uploads are supported!")
+
+            try:
+                image_id, thumbnail_id = store_image(unit_id, file.file, file.filename, file.content_type)
+            except InvalidImageError:
+                raise HTTPException(status_code=400, detail="Unable to read the uploaded image!")
+            except ImageTooLargeError as e:
+                raise HTTPException(status_code=413, detail=str(e))
+
+            notify_project_event(db.session, project_id, 'submission_edited', [unit_id], fields=['image'])
+            submission_crud.update(id=submission.id, obj_in={'image_id': image_id, 'thumbnail_id': thumbnail_id},
+                                   returning=[Submission.id])
+
+            image_store = get_image_store()
 
             resp = {
-                'selected': result.selected,
-                'impressions': result.impressions,
-                'cpm': cpm,
-                'estimated_budget': total_media_cost
+                'unit_id': unit_id,
+                'image_id': image_id,
+                'thumbnail_id': thumbnail_id,
+                'image_url': image_store.url(image_id),
+                'thumbnail_url': image_store.url(thumbnail_id)
             }
 
             return resp
 
+        @api_router.post("/{wilkins_id}/thumbnails", status_code=200, response_model=ThumbnailBackfillOut)
+        def generate_project_thumbnails(
+                wilkins_id: str,
+                limit: int = Query(100, ge=1, le=1000),
+                after_id: int = Query(0, ge=0),
+                user: dict = Depends(get_write_user)
+        ) -> Any:
+
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
+
+            return generate_missing_thumbnails(db.session, project_id, limit=limit, after_id=after_id)
+
+        @api_router.get("/clients", status_code=200, response_model=List[str])
+        def fetch_project_clients(search: str = Query(None), user: dict = Depends(get_read_user)) -> Any:
+
+            return autocomplete.clients(db.session).search(search)
+
+        @api_router.get("/vendors", status_code=200, response_model=List[str])
+        def fetch_project_vendors(
+                search: str = Query(None),
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+
+            return autocomplete.vendors(db.session).search(search)
+
+        @api_router.put("/{wilkins_id}/select-submissions", status_code=200, response_model=SelectedSubmissionOut)
+        def select_submissions(
+                wilkins_id: str,
+                selected_submissions: SelectedSubmissionIn,
+                user: dict = Depends(get_write_user)
+        ) -> Any:
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=400, detail='Project not found!')
+
+            if (selected_submissions.unit_ids is None) == (selected_submissions.filters is None):
+                raise HTTPException(status_code=400, detail='Either unit_ids or filters is required!')
+
+            if selected_submissions.unit_ids is not None:
+                criteria = [Submission.unit_id.in_(selected_submissions.unit_ids)]
+            else:
+                criteria = submission_criteria(selected_submissions.filters)
+
+            # one UPDATE however many units match, leaving the ones already (de)selected alone
+            stmt = update(Submission).where(
+                Submission.project_id == project_id,
+                Submission.selected.is_distinct_from(selected_submissions.selected),
+                *criteria
+            ).values(selected=selected_submissions.selected).returning(Submission.unit_id)
+            changed = db.session.execute(stmt, execution_options={'synchronize_session': False}).scalars().all()
+
+            notify_project_event(db.session, project_id, 'selection_changed', changed,
+                                 selected=selected_submissions.selected)
+            db.session.commit()
+
+            return submission_crud.selection_stats(project_id)
+
         @api_router.get("/{wilkins_id}/submission-media-types", status_code=200, response_model=List[str])
+        @coalesce_reads()
         def fetch_project_submission_media_types(
                 wilkins_id: str,
                 search: str = Query(None),
                 state: str = Query(None),
                 town: str = Query(None),
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                return []
+
             query = db.session.query(Submission.media_type)
             query = query.filter(Submission.media_type.isnot(None))
-
-            query = query.join(Submission.project)
-            query = query.filter(Project.wilkins_id == wilkins_id)
+            query = query.filter(Submission.project_id == project_id)
 
             if state:
                 query = query.filter(Submission.state == state)
@@ -394,60 +784,39 @@ class ProjectRouter:
                 wilkins_id: str,
                 search: str = Query(None),
                 state: str = Query(None),
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
-            query = db.session.query(Submission.town)
-            query = query.filter(Submission.town.isnot(None))
-
-            query = query.join(Submission.project)
-            query = query.filter(Project.wilkins_id == wilkins_id)
-
-            if state:
-                query = query.filter(Submission.state == state)
-
-            if search:
-                query = query.filter(Submission.town.ilike(f'%%{search}%%'))
-
-            query = query.distinct()
-            query = query.limit(10)
-            records = query.all()
-
-            resp = [rec.town for rec in records]
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                return []
 
-            return resp
+            towns = autocomplete.towns(db.session, project_id, get_event_broker().version(project_id))
+            return towns.search(search, tag=state or None)
 
         @api_router.get("/{wilkins_id}/submission-states", status_code=200, response_model=List[str])
         def fetch_project_submission_states(
                 wilkins_id: str,
                 search: str = Query(None),
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
-            query = db.session.query(Submission.state)
-            query = query.filter(Submission.state.isnot(None))
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                return []
 
-            query = query.join(Submission.project)
-            query = query.filter(Project.wilkins_id == wilkins_id)
-            if search:
-                query = query.filter(Submission.state.ilike(f'%%{search}%%'))
-
-            query = query.distinct()
-            query = query.limit(10)
-            records = query.all()
-
-            resp = [rec.state for rec in records]
-
-            return resp
+            states = autocomplete.states(db.session, project_id, get_event_broker().version(project_id))
+            return states.search(search)
 
         @api_router.get("/{wilkins_id}/submission-vendors", status_code=200, response_model=List[str])
+        @coalesce_reads()
         def fetch_project_submission_vendors(
                 wilkins_id: str,
                 search: str = Query(None),
                 state: str = Query(None),
                 town: str = Query(None),
                 media_type: str = Query(None),
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
             query = db.session.query(Vendor.name)
@@ -477,10 +846,58 @@ class ProjectRouter:
 
             return resp
 
+        @api_router.get("/{wilkins_id}/duplicates", status_code=200, response_model=FetchDuplicatesSchema)
+        def fetch_project_duplicates(
+                wilkins_id: str,
+                distance_meters: float = Query(DUPLICATE_DISTANCE_METERS, gt=0, le=1000),
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
+
+            groups = project_duplicate_groups(db.session, project_id, distance_meters)
+
+            resp = {
+                'data': groups,
+                'total_groups': len(groups),
+                'distance_meters': distance_meters
+            }
+
+            return resp
+
+        @api_router.get("/{wilkins_id}/snapshot", status_code=200, response_class=FileResponse)
+        def fetch_project_snapshot(
+                wilkins_id: str,
+                format: SnapshotFormat = SnapshotFormat.parquet,
+                if_none_match: str = Header(None),
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+            """
+            All of the project's submissions as a typed Parquet or Arrow IPC file, e.g. for
+            pandas.read_parquet. Built once per change to the project's submissions and served
+            from the local cache until the next one.
+            """
+
+            project_id = identity_cache.get_project_id(wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
+
+            path, version = get_snapshot(db.session, project_id, format)
+
+            etag = f'"{version}"'
+            if if_none_match == etag:
+                return Response(status_code=304, headers={'ETag': etag})
+
+            return FileResponse(path, media_type=MEDIA_TYPES[format], filename=f'{wilkins_id}.{format.value}',
+                                headers={'ETag': etag})
+
         @api_router.get("/{wilkins_id}/stats", status_code=200, response_model=ProjectStats)
+        @coalesce_reads()
         def fetch_project_stats(
                 wilkins_id: str,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
             project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
@@ -495,24 +912,7 @@ class ProjectRouter:
             query = db.session.query(Submission.vendor_id).filter(Submission.project_id == project.id)
             vendors_in_submission = query.distinct().count()
 
-            query = db.session.query(func.sum(Submission.a18_weekly_impressions).label('impressions'),
-                                     func.count(Submission.id).label('selected'))
-            query = query.filter(Submission.project_id == project.id)
-            query = query.filter(Submission.selected.is_(True))
-            result = query.one_or_none()
-
-            query = db.session.query(Submission)
-            query = query.filter(Submission.project_id == project.id)
-            query = query.filter(Submission.selected.is_(True))
-            submissions = query.all()
-
-            total_media_cost = sum(rec.total_media_cost for rec in submissions if rec.total_media_cost is not None)
-            # total_cost = sum(rec.total_cost for rec in submissions if rec.total_cost is not None)
-
-            if result.impressions is not None and result.impressions > 0:
-                cpm = total_media_cost / result.impressions * 1000
-            else:
-                cpm = 0
+            selection_stats = submission_crud.selection_stats(project.id)
 
             resp = {
                 "project_name": project.name,
@@ -520,18 +920,38 @@ class ProjectRouter:
                 "vendors_in_submission": vendors_in_submission,
                 "sites": total_submissions,
                 "total_budget": project.budget,
-                "selected": result.selected,
-                "impressions": result.impressions,
-                "cpm": cpm,
-                "estimated_budget": total_media_cost
+                **selection_stats
             }
 
             return resp
 
+        @api_router.get("/{wilkins_id}/events", status_code=200, response_class=StreamingResponse)
+        async def stream_project_changes(
+                wilkins_id: str,
+                user: dict = Depends(get_read_user)
+        ) -> Any:
+            """
+            Server-sent events for changes to the project, pushed once they are committed: submission_upserted,
+            submission_edited, selection_changed and project_updated with the affected unit_ids, followed by
+            a `stats` event with the new selection totals. `resync` means events may have been missed and
+            the client should reload.
+            """
+
+            project_id = await run_in_threadpool(identity_cache.get_project_id, wilkins_id)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
+
+            # the stream outlives the request session, don't hold a connection for it
+            db.session.close()
+
+            headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            return StreamingResponse(stream_project_events(get_event_broker(), project_id),
+                                     media_type='text/event-stream', headers=headers)
+
         @api_router.get("/{wilkins_id}", status_code=200, response_model=ProjectOut)
         def fetch_project(
                 wilkins_id: str,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_read_user)
         ) -> Any:
 
             project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
@@ -545,30 +965,30 @@ class ProjectRouter:
         def create_vendor(
                 vendor_in: VendorCreateRequestSchema,
                 wilkins_id: str,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_write_user)
         ) -> Any:
 
-            vendor = db.session.query(Vendor).filter(Vendor.name == vendor_in.name).first()
+            project_id = identity_cache.get_project_id(wilkins_id)
 
-            if vendor is None:
-                vendor = vendor_crud.create(vendor_in)
+            if project_id is None:
+                raise HTTPException(status_code=404, detail="Project not found!")
 
-            project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
+            vendor = db.session.query(Vendor).filter(Vendor.name == vendor_in.name).first()
 
-            if project is None:
-                raise HTTPException(status_code=404, detail="Project not found!")
+            if vendor is None:
+                vendor_columns = vendor_crud.columns_for(VendorCreateResponseSchema, 'id')
+                vendor = vendor_crud.create(vendor_in, returning=vendor_columns)
+                autocomplete.add_vendor(vendor.name)
 
-            query = db.session.query(ProjectVendor)
-            query = query.filter(ProjectVendor.project_id == project.id)
-            query = query.filter(ProjectVendor.vendor_id == vendor.id)
-            project_vendor = query.first()
+            identity_cache.set_vendor_id(vendor.name, vendor.id)
 
-            if project_vendor is None:
+            if not identity_cache.project_vendor_exists(project_id, vendor.id):
                 project_vendor_in = {
                     'vendor_id': vendor.id,
-                    'project_id': project.id,
+                    'project_id': project_id,
                 }
-                project_vendor_crud.create(project_vendor_in)
+                project_vendor_crud.create(project_vendor_in, returning=[ProjectVendor.id])
+                identity_cache.add_project_vendor(project_id, vendor.id)
 
             return vendor
 
@@ -576,7 +996,7 @@ class ProjectRouter:
         def create_user(
                 user_in: UserCreateRequestSchema,
                 wilkins_id: str,
-                user: dict = Depends(get_azure_user)
+                user: dict = Depends(get_write_user)
         ) -> Any:
 
             if not user['is_cli_user']:
@@ -586,24 +1006,24 @@ class ProjectRouter:
 
             if user is None:
                 user_in.password = get_password_hash(user_in.password)
-                user = user_crud.create(user_in)
+                user = user_crud.create(user_in, returning=user_crud.columns_for(UserCreateResponseSchema, 'id'))
 
-            project = db.session.query(Project).filter(Project.wilkins_id == wilkins_id).first()
+            project_id = identity_cache.get_project_id(wilkins_id)
 
-            if project is None:
+            if project_id is None:
                 raise HTTPException(status_code=404, detail="Project not found!")
 
             query = db.session.query(UserProject)
             query = query.filter(UserProject.user_id == user.id)
-            query = query.filter(UserProject.project_id == project.id)
+            query = query.filter(UserProject.project_id == project_id)
             user_project = query.first()
 
             if user_project is None:
                 user_project_in = {
                     'user_id': user.id,
-                    'project_id': project.id,
+                    'project_id': project_id,
                 }
-                user_project_crud.create(user_project_in)
+                user_project_crud.create(user_project_in, returning=[UserProject.id])
 
             return user
 
@@ -1,8 +1,9 @@
-from datetime import date
-from typing import Optional, List
-from pydantic import BaseModel, ConfigDict, EmailStr
+from datetime import date, datetime
+from enum import Enum
+from typing import Optional, List, Dict, Any
+from pydantic import BaseModel, ConfigDict, EmailStr, Field
 
-from apiserver.models import ProjectStatusEnum, CostBasisEnum
+from apiserver.models import ProjectStatusEnum, CostBasisEnum, JobStatusEnum
 
 
 class RequestBaseSchema(BaseModel):
@@ -71,6 +72,10 @@ class ProjectStats(RequestBaseSchema):
     impressions: Optional[int]
     cpm: float
     estimated_budget: float
+    # deduplicated 4-week A18+ reach (%) and frequency of the selection
+    reach: Optional[float]
+    frequency: Optional[float]
+    grps: Optional[float]
 
 
 class VendorCreateRequestSchema(RequestBaseSchema):
@@ -150,10 +155,19 @@ class SubmissionCreateIn(RequestBaseSchema, SubmissionBase):
     vendor_email: Optional[EmailStr] = None
 
 
+class IngestResult(str, Enum):
+    created = "created"
+    updated = "updated"
+    # same content as when last ingested, not written
+    unchanged = "unchanged"
+
+
 class SubmissionCreateOut(SubmissionBase):
     unit_id: str
     vendor: Vendor
     selected: bool
+    possible_duplicates: List[str] = []
+    ingest_result: Optional[IngestResult] = None
 
 
 class SubmissionUpdateIn(RequestBaseSchema, SubmissionBase):
@@ -164,6 +178,25 @@ class SubmissionUpdateOut(SubmissionCreateOut):
     pass
 
 
+class SubmissionBatchUpdateIn(RequestBaseSchema):
+    unit_id: str
+    changes: SubmissionUpdateIn
+
+
+class SubmissionBatchUpdateOut(BaseModel):
+    updated: int
+
+
+class SubmissionBulkOut(BaseModel):
+    # created + updated
+    upserted: int
+    created: int
+    updated: int
+    unchanged: int
+    # locked by a planner, or already in another project
+    skipped: List[str]
+
+
 class ProjectSchema(BaseModel):
     wilkins_id: str
     name: Optional[str] = None
@@ -182,7 +215,11 @@ class FetchSubmissionSchema(SubmissionBase):
     unit_id: str
     vendor: str
     selected: bool
+    total_media_cost: Optional[float] = None
+    total_cost: Optional[float] = None
+    cpm: Optional[float] = None
     image_url: Optional[str]
+    thumbnail_url: Optional[str] = None
 
 
 class ProjectSubmissionsSchema(BaseModel):
@@ -190,8 +227,73 @@ class ProjectSubmissionsSchema(BaseModel):
     total_records: int
 
 
+class DuplicateUnitOut(BaseModel):
+    unit_id: str
+    vendor: str
+    geopath_id: Optional[str]
+    latitude: Optional[float]
+    longitude: Optional[float]
+
+
+class DuplicateGroupOut(BaseModel):
+    units: List[DuplicateUnitOut]
+    matched_by: List[str]
+    max_distance_meters: Optional[float]
+
+
+class FetchDuplicatesSchema(BaseModel):
+    data: List[DuplicateGroupOut]
+    total_groups: int
+    distance_meters: float
+
+
+class SubmissionImageOut(BaseModel):
+    unit_id: str
+    image_id: str
+    thumbnail_id: str
+    image_url: str
+    thumbnail_url: str
+
+
+class ThumbnailBackfillOut(BaseModel):
+    processed: int
+    failed: List[str]
+    remaining: int
+    # pass as `after_id` to continue past images that failed
+    last_id: int
+
+
+class AvailabilityMatch(str, Enum):
+    # available for the whole window
+    contains = "contains"
+    # available for any part of the window
+    overlaps = "overlaps"
+
+
+class SubmissionFilter(RequestBaseSchema):
+    """The filters of the submissions listing, without paging and sorting."""
+
+    state: Optional[str] = None
+    town: Optional[str] = None
+    media_type: Optional[str] = None
+    vendor: Optional[str] = None
+    illuminated: Optional[bool] = None
+    selected: Optional[bool] = None
+    min_media_cost: Optional[float] = None
+    max_media_cost: Optional[float] = None
+    min_cpm: Optional[float] = None
+    max_cpm: Optional[float] = None
+    available_from: Optional[date] = None
+    available_to: Optional[date] = None
+    availability: AvailabilityMatch = AvailabilityMatch.contains
+    min_weeks: Optional[int] = Field(None, ge=1)
+    search: Optional[str] = None
+
+
 class SelectedSubmissionIn(RequestBaseSchema):
-    unit_ids: List[str]
+    # either the units to (de)select, or the filters that match them
+    unit_ids: Optional[List[str]] = None
+    filters: Optional[SubmissionFilter] = None
     selected: bool
 
 
@@ -200,6 +302,97 @@ class SelectedSubmissionOut(BaseModel):
     impressions: Optional[int]
     cpm: float
     estimated_budget: float
+    reach: Optional[float]
+    frequency: Optional[float]
+    grps: Optional[float]
+
+
+class JobCreateIn(RequestBaseSchema):
+    kind: str
+    params: Dict[str, Any] = {}
+
+
+class JobOut(BaseModel):
+    id: int
+    kind: str
+    status: JobStatusEnum
+    params: Optional[Dict[str, Any]]
+    progress: float
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    attempts: int
+    created_by: Optional[str]
+    created_at: Optional[datetime]
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime]
+
+
+class FetchAllJobsSchema(BaseModel):
+    data: List[JobOut]
+    total_records: int
 
 
 SubmissionSchema.model_rebuild()
+
+
+class MarketCpmOut(BaseModel):
+    market: Optional[str]
+    media_type: Optional[str]
+    sites: int
+    media_cost: Optional[float]
+    impressions: Optional[int]
+    cpm: Optional[float]
+
+
+class FetchMarketCpmSchema(BaseModel):
+    data: List[MarketCpmOut]
+    refreshed_at: Optional[datetime]
+
+
+class VendorRateOut(BaseModel):
+    vendor: str
+    sites: int
+    rate_cards: int
+    avg_rate_card: Optional[float]
+    min_rate_card: Optional[float]
+    max_rate_card: Optional[float]
+    stddev_rate_card: Optional[float]
+    spread: Optional[float]
+
+
+class FetchVendorRatesSchema(BaseModel):
+    data: List[VendorRateOut]
+    refreshed_at: Optional[datetime]
+
+
+class WinRateOut(BaseModel):
+    # vendor name, market or media type
+    group: Optional[str]
+    projects: int
+    sold: int
+    lost: int
+    # sold / (sold + lost) projects
+    win_rate: Optional[float]
+    sites: int
+    selected: int
+    # selected / all sites, of projects in any status
+    selection_rate: Optional[float]
+
+
+class FetchWinRatesSchema(BaseModel):
+    data: List[WinRateOut]
+    refreshed_at: Optional[datetime]
+
+
+class AllocationOut(BaseModel):
+    location: str
+    size: int
+    count: int
+
+
+class ProfileOut(BaseModel):
+    pid: int
+    seconds: float
+    samples: int
+    collapsed: str
+    allocations: Optional[List[AllocationOut]]
@@ -0,0 +1,110 @@
+"""
+Production entry point: a gunicorn master preforking uvicorn worker processes.
+
+    python -m apiserver.serve
+
+Everything is configured from the environment, see the Serving Settings in .env.sample.
+"""
+import multiprocessing
+import os
+from typing import Any, Dict
+
+from gunicorn.app.base import BaseApplication
+from uvicorn.workers import UvicornWorker as BaseUvicornWorker
+
+
+class UvicornWorker(BaseUvicornWorker):
+    # "auto" picks uvloop/httptools when they are installed and falls back to asyncio/h11
+    CONFIG_KWARGS = {
+        'loop': os.environ.get('UVICORN_LOOP', 'auto'),
+        'http': os.environ.get('UVICORN_HTTP', 'auto'),
+        'proxy_headers': True,
+    }
+
+
+def get_serving_config() -> Dict[str, Any]:
+    workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+
+    return {
+        'bind': f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', 3001)}",
+        'workers': workers,
+        'worker_class': 'apiserver.serve.UvicornWorker',
+        # recycle workers so slow leaks cannot build up, jitter keeps them from restarting together
+        'max_requests': int(os.environ.get('WORKER_MAX_REQUESTS', 10000)),
+        'max_requests_jitter': int(os.environ.get('WORKER_MAX_REQUESTS_JITTER', 1000)),
+        'timeout': int(os.environ.get('WORKER_TIMEOUT', 60)),
+        'graceful_timeout': int(os.environ.get('WORKER_GRACEFUL_TIMEOUT', 30)),
+        'keepalive': int(os.environ.get('WORKER_KEEPALIVE', 5)),
+        'forwarded_allow_ips': os.environ.get('FORWARDED_ALLOW_IPS', '*'),
+        'accesslog': '-' if os.environ.get('ACCESS_LOG', 'false').lower() == 'true' else None,
+        'errorlog': '-',
+    }
+
+
+# connections every worker holds outside its pool: the event broker's LISTEN connection
+WORKER_EXTRA_CONNECTIONS = 1
+
+
+def get_pool_config(workers: int) -> Dict[str, int]:
+    """
+    Per-worker pool size. With DB_CONNECTION_BUDGET set, the budget is split evenly between the
+    workers after setting aside the connections each holds outside its pool, and no overflow is
+    allowed, so the whole deployment never opens more connections than the budget. Otherwise
+    DB_POOL_SIZE/DB_MAX_OVERFLOW apply to every worker as they are.
+
+    :raises SystemExit: when the budget leaves a worker without a pool connection.
+    """
+
+    budget = os.environ.get('DB_CONNECTION_BUDGET')
+    if budget:
+        pool_size = int(budget) // workers - WORKER_EXTRA_CONNECTIONS
+        if pool_size < 1:
+            raise SystemExit(f'DB_CONNECTION_BUDGET={budget} is too small for {workers} workers, each needs '
+                             f'{WORKER_EXTRA_CONNECTIONS + 1} connections: lower WEB_CONCURRENCY or raise the budget')
+        return {'DB_POOL_SIZE': pool_size, 'DB_MAX_OVERFLOW': 0}
+
+    return {
+        'DB_POOL_SIZE': int(os.environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    }
+
+
+class Server(BaseApplication):
+    def __init__(self, options: Dict[str, Any]):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            if value is not None:
+                self.cfg.set(key, value)
+
+    def load(self):
+        # imported in each worker after the fork, so every worker gets its own engine and pool
+        from apiserver.main import app
+
+        return app
+
+
+def main():
+    options = get_serving_config()
+    pool = get_pool_config(options['workers'])
+
+    # the workers read these when they import apiserver.db.session
+    for key, value in pool.items():
+        os.environ[key] = str(value)
+
+    print('Serving apiserver with:')
+    for key, value in {**options, **pool,
+                       'UVICORN_LOOP': UvicornWorker.CONFIG_KWARGS['loop'],
+                       'UVICORN_HTTP': UvicornWorker.CONFIG_KWARGS['http']}.items():
+        print(f'  {key} = {value}')
+    max_connections = options['workers'] * (pool['DB_POOL_SIZE'] + pool['DB_MAX_OVERFLOW'] + WORKER_EXTRA_CONNECTIONS)
+    print(f'  at most {max_connections} database connections across all workers, '
+          f'{WORKER_EXTRA_CONNECTIONS} per worker outside the pool')
+
+    Server(options).run()
+
+
+if __name__ == '__main__':
+    main()
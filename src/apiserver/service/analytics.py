@@ -0,0 +1,223 @@
+import math
+import os
+from datetime import timedelta
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import BigInteger, and_, cast, delete, func, insert, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from apiserver.models import PortfolioRollup, Project, ProjectStatusEnum, RollupWatermark, Submission, Vendor
+
+# Submissions are picked up by updated_at, which is the start time of the transaction that wrote them.
+# Re-reading a window before the last watermark catches transactions that committed after the last
+# refresh but started before it.
+ROLLUP_REFRESH_OVERLAP_SECONDS = int(os.environ.get('ROLLUP_REFRESH_OVERLAP_SECONDS', 300))
+
+PORTFOLIO_WATERMARK = 'portfolio'
+# serializes refreshes, so two workers never rebuild the same project at once
+PORTFOLIO_LOCK_ID = 0x70F7F011
+
+rollups_table = PortfolioRollup.__table__
+
+
+class WinRateGroup(str, Enum):
+    vendor = "vendor"
+    market = "market"
+    media_type = "media_type"
+
+ROLLUP_COLUMNS = [
+    'project_id', 'market', 'media_type', 'vendor_id', 'sites', 'selected', 'media_cost', 'cpm_media_cost',
+    'cpm_impressions', 'rate_card_count', 'rate_card_sum', 'rate_card_sum_sq', 'rate_card_min', 'rate_card_max',
+]
+
+
+def rollup_select(project_ids: List[int]):
+    has_cpm = and_(Submission.total_media_cost.isnot(None), Submission.a18_weekly_impressions > 0)
+    rate_card = Submission.four_week_rate_card
+
+    query = select(
+        Submission.project_id,
+        Submission.market,
+        Submission.media_type,
+        Submission.vendor_id,
+        func.count(),
+        func.count().filter(Submission.selected.is_(True)),
+        func.sum(Submission.total_media_cost),
+        func.sum(Submission.total_media_cost).filter(has_cpm),
+        func.sum(Submission.a18_weekly_impressions).filter(has_cpm),
+        func.count(rate_card),
+        func.sum(rate_card),
+        func.sum(rate_card * rate_card),
+        func.min(rate_card),
+        func.max(rate_card),
+    )
+    query = query.where(Submission.project_id.in_(project_ids))
+    return query.group_by(Submission.project_id, Submission.market, Submission.media_type, Submission.vendor_id)
+
+
+def refresh_portfolio_rollups(session: Session, full: bool = False) -> Dict[str, Any]:
+    """
+    Rebuild the rollup rows of every project with submissions changed since the last refresh.
+
+    Whole projects are rebuilt rather than patching groups, so submissions that moved to another
+    market, media type or vendor leave their old group. Deleted submissions are only dropped by a
+    `full` refresh, which rebuilds everything.
+    """
+
+    session.execute(select(func.pg_advisory_xact_lock(PORTFOLIO_LOCK_ID)))
+    refresh_started = session.execute(select(func.now())).scalar()
+
+    watermark = session.execute(
+        select(RollupWatermark.watermark).where(RollupWatermark.name == PORTFOLIO_WATERMARK)
+    ).scalar()
+
+    if full or watermark is None:
+        session.execute(delete(rollups_table))
+        project_ids = session.execute(select(Project.id)).scalars().all()
+    else:
+        since = watermark - timedelta(seconds=ROLLUP_REFRESH_OVERLAP_SECONDS)
+        query = select(Submission.project_id).where(Submission.updated_at > since).distinct()
+        project_ids = session.execute(query).scalars().all()
+        if project_ids:
+            session.execute(delete(rollups_table).where(rollups_table.c.project_id.in_(project_ids)))
+
+    rows = 0
+    if project_ids:
+        stmt = insert(rollups_table).from_select(ROLLUP_COLUMNS, rollup_select(project_ids))
+        rows = session.execute(stmt).rowcount
+
+    stmt = pg_insert(RollupWatermark.__table__).values(name=PORTFOLIO_WATERMARK, watermark=refresh_started,
+                                                       refreshed_at=func.now())
+    stmt = stmt.on_conflict_do_update(index_elements=['name'],
+                                      set_={'watermark': refresh_started, 'refreshed_at': func.now()})
+    session.execute(stmt)
+    session.commit()
+
+    return {'full': full or watermark is None, 'projects': len(project_ids), 'rows': rows}
+
+
+def get_refreshed_at(session: Session):
+    return session.query(RollupWatermark.refreshed_at).filter(RollupWatermark.name == PORTFOLIO_WATERMARK).scalar()
+
+
+def _filter_rollups(query, statuses: Optional[List[ProjectStatusEnum]], market: Optional[str],
+                    media_type: Optional[str]):
+    if statuses:
+        query = query.join(Project, Project.id == PortfolioRollup.project_id)
+        query = query.filter(Project.status.in_(statuses))
+    if market:
+        query = query.filter(PortfolioRollup.market == market)
+    if media_type:
+        query = query.filter(PortfolioRollup.media_type == media_type)
+    return query
+
+
+def cpm_by_market(session: Session, statuses: Optional[List[ProjectStatusEnum]] = None,
+                  market: Optional[str] = None, media_type: Optional[str] = None,
+                  min_sites: int = 1) -> List[Dict[str, Any]]:
+    r = PortfolioRollup
+    sites = func.sum(r.sites)
+    query = session.query(r.market, r.media_type, sites.label('sites'),
+                          func.sum(r.media_cost).label('media_cost'),
+                          func.sum(r.cpm_media_cost).label('cpm_media_cost'),
+                          # sum(bigint) is numeric in Postgres
+                          cast(func.sum(r.cpm_impressions), BigInteger).label('impressions'))
+    query = _filter_rollups(query, statuses, market, media_type)
+    query = query.group_by(r.market, r.media_type).having(sites >= min_sites)
+    query = query.order_by(sites.desc(), r.market, r.media_type)
+
+    data = []
+    for row in query.all():
+        data.append({
+            'market': row.market,
+            'media_type': row.media_type,
+            'sites': row.sites,
+            'media_cost': row.media_cost,
+            'impressions': row.impressions,
+            'cpm': row.cpm_media_cost / row.impressions * 1000 if row.impressions else None,
+        })
+    return data
+
+
+def vendor_rates(session: Session, statuses: Optional[List[ProjectStatusEnum]] = None,
+                 market: Optional[str] = None, media_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    r = PortfolioRollup
+    query = session.query(Vendor.name.label('vendor'),
+                          func.sum(r.sites).label('sites'),
+                          func.sum(r.rate_card_count).label('count'),
+                          func.sum(r.rate_card_sum).label('total'),
+                          func.sum(r.rate_card_sum_sq).label('total_sq'),
+                          func.min(r.rate_card_min).label('min'),
+                          func.max(r.rate_card_max).label('max'))
+    query = query.join(Vendor, Vendor.id == r.vendor_id)
+    query = _filter_rollups(query, statuses, market, media_type)
+    query = query.group_by(Vendor.name).order_by(Vendor.name)
+
+    data = []
+    for row in query.all():
+        avg = stddev = None
+        if row.count:
+            avg = row.total / row.count
+        if row.count and row.count > 1:
+            # sample standard deviation from the running sums, clamped against rounding below zero
+            stddev = math.sqrt(max(row.total_sq - row.total * row.total / row.count, 0) / (row.count - 1))
+
+        data.append({
+            'vendor': row.vendor,
+            'sites': row.sites,
+            'rate_cards': row.count,
+            'avg_rate_card': avg,
+            'min_rate_card': row.min,
+            'max_rate_card': row.max,
+            'stddev_rate_card': stddev,
+            'spread': row.max - row.min if row.count else None,
+        })
+    return data
+
+
+def win_rates(session: Session, group_by: WinRateGroup = WinRateGroup.vendor, vendor: Optional[str] = None,
+              market: Optional[str] = None, media_type: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    Project win rates per vendor, market or media type: of the projects with sites in the group
+    that were decided, the share Sold rather than Lost. Also the selection rate, the share of the
+    group's sites that were selected, across projects of any status.
+    """
+
+    r = PortfolioRollup
+    key = {
+        WinRateGroup.vendor: Vendor.name,
+        WinRateGroup.market: r.market,
+        WinRateGroup.media_type: r.media_type,
+    }[group_by]
+
+    projects = func.count(func.distinct(r.project_id))
+    query = session.query(key.label('group'),
+                          projects.label('projects'),
+                          projects.filter(Project.status == ProjectStatusEnum.sold).label('sold'),
+                          projects.filter(Project.status == ProjectStatusEnum.lost).label('lost'),
+                          func.sum(r.sites).label('sites'),
+                          func.sum(r.selected).label('selected'))
+    query = query.join(Project, Project.id == r.project_id)
+    if group_by == WinRateGroup.vendor or vendor:
+        query = query.join(Vendor, Vendor.id == r.vendor_id)
+    if vendor:
+        query = query.filter(Vendor.name == vendor)
+    query = _filter_rollups(query, None, market, media_type)
+    query = query.group_by(key).order_by(key)
+
+    data = []
+    for row in query.all():
+        decided = row.sold + row.lost
+        data.append({
+            'group': row.group,
+            'projects': row.projects,
+            'sold': row.sold,
+            'lost': row.lost,
+            'win_rate': row.sold / decided if decided else None,
+            'sites': row.sites,
+            'selected': row.selected,
+            'selection_rate': row.selected / row.sites if row.sites else None,
+        })
+    return data
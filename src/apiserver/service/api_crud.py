@@ -1,5 +1,13 @@
+from typing import Any, Dict, List, Optional, Type
+
+from fastapi_sqlalchemy import db
+from pydantic import BaseModel
+from sqlalchemy import func, select
+from sqlalchemy.engine import Row
+
 from apiserver.service.base_crud import CRUDBase
-from apiserver.models import Project, Submission, Vendor, ProjectVendor, User, UserProject
+from apiserver.service.reach import estimate_reach_frequency
+from apiserver.models import Project, Submission, Vendor, ProjectVendor, User, UserProject, Job
 
 
 class ProjectCrud(CRUDBase):
@@ -10,7 +18,43 @@ project_crud = ProjectCrud(Project)
 
 
 class SubmissionCrud(CRUDBase):
-    pass
+    def columns_with_vendor(self, schema: Type[BaseModel]) -> List[Any]:
+        """Columns backing a submission response schema plus the vendor name, labelled `vendor_name`."""
+        vendor_name = select(Vendor.name).where(Vendor.id == Submission.vendor_id).scalar_subquery()
+        return [*self.columns_for(schema), vendor_name.label('vendor_name')]
+
+    @staticmethod
+    def with_vendor(submission: Row, vendor_name: Optional[str] = None) -> Dict[str, Any]:
+        """Shape a RETURNING row for SubmissionCreateOut / SubmissionUpdateOut."""
+        resp = dict(submission._mapping)
+        resp['vendor'] = {'name': resp.pop('vendor_name', vendor_name)}
+        return resp
+
+    def selection_stats(self, project_id: int) -> Dict[str, Any]:
+        query = db.session.query(func.sum(Submission.a18_weekly_impressions).label('impressions'),
+                                 func.count(Submission.id).label('selected'),
+                                 func.coalesce(func.sum(Submission.total_media_cost), 0).label('total_media_cost'),
+                                 # one array per column rather than a row per unit, which is much faster to load
+                                 func.array_agg(Submission.a18_4wk_reach).label('reach'),
+                                 func.array_agg(Submission.a18_4wk_freq).label('frequency'))
+        query = query.filter(Submission.project_id == project_id)
+        query = query.filter(Submission.selected.is_(True))
+        result = query.one()
+
+        if result.impressions is not None and result.impressions > 0:
+            cpm = result.total_media_cost / result.impressions * 1000
+        else:
+            cpm = 0
+
+        reach_frequency = estimate_reach_frequency(result.reach or [], result.frequency or [])
+
+        return {
+            'selected': result.selected,
+            'impressions': result.impressions,
+            'cpm': cpm,
+            'estimated_budget': result.total_media_cost,
+            **reach_frequency
+        }
 
 
 submission_crud = SubmissionCrud(Submission)
@@ -42,3 +86,10 @@ class UserProjectCrud(CRUDBase):
 
 
 user_project_crud = UserProjectCrud(UserProject)
+
+
+class JobCrud(CRUDBase):
+    pass
+
+
+job_crud = JobCrud(Job)
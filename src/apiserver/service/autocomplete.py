@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from itertools import chain
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+from sqlalchemy.orm import Session
+
+from apiserver.core.cache import LRUCache
+from apiserver.core.singleflight import SingleFlight
+from apiserver.models import Project, Submission, Vendor
+
+# Writes in this process are added to the indexes right away. Other processes' writes are picked up
+# by rebuilding an index on use once it is this old, for project indexes only if the project changed.
+AUTOCOMPLETE_REFRESH_SECONDS = float(os.environ.get('AUTOCOMPLETE_REFRESH_SECONDS', 30))
+# project indexes are rebuilt after this long even without change events (e.g. no listener running)
+AUTOCOMPLETE_MAX_AGE_SECONDS = float(os.environ.get('AUTOCOMPLETE_MAX_AGE_SECONDS', 600))
+AUTOCOMPLETE_MAX_PROJECTS = int(os.environ.get('AUTOCOMPLETE_MAX_PROJECTS', 256))
+
+
+def normalize_term(value: str) -> str:
+    return ' '.join(value.casefold().split())
+
+
+class PrefixIndex:
+    """
+    Distinct values kept in sorted arrays of normalized (case-folded, whitespace-collapsed) keys: the
+    whole values, the text from the start of each of their later words, and the text from every other
+    position. Prefix, word prefix and infix searches are then each a binary search plus a short scan.
+
+    Values can carry tags (e.g. the states a town is in) to filter the results by.
+
+    The arrays are replaced rather than modified on writes, so searches need no lock.
+    """
+
+    def __init__(self, values: Iterable[Tuple[str, Optional[Hashable]]] = ()):
+        self.lock = threading.Lock()
+        self.tags: Dict[str, Set[Hashable]] = {}
+        self.keys: List[Tuple[str, str]] = []
+        self.words: List[Tuple[str, str]] = []
+        self.infixes: List[Tuple[str, str]] = []
+        self.add_many(values)
+
+    @staticmethod
+    def _suffixes(key: str) -> Tuple[List[str], List[str]]:
+        words, infixes = [], []
+        for i in range(1, len(key)):
+            if key[i] == ' ':
+                continue
+            (words if key[i - 1] == ' ' else infixes).append(key[i:])
+        return words, infixes
+
+    def add(self, value: str, tag: Optional[Hashable] = None) -> None:
+        self.add_many([(value, tag)])
+
+    def add_many(self, values: Iterable[Tuple[str, Optional[Hashable]]]) -> None:
+        with self.lock:
+            keys, words, infixes = [], [], []
+            for value, tag in values:
+                if value not in self.tags:
+                    self.tags[value] = set()
+                    key = normalize_term(value)
+                    keys.append((key, value))
+                    value_words, value_infixes = self._suffixes(key)
+                    words += ((suffix, value) for suffix in value_words)
+                    infixes += ((suffix, value) for suffix in value_infixes)
+
+                if tag is not None:
+                    self.tags[value].add(tag)
+
+            if keys:
+                self.keys = sorted(self.keys + keys)
+                self.words = sorted(self.words + words)
+                self.infixes = sorted(self.infixes + infixes)
+
+    @staticmethod
+    def _starting_with(entries: List[Tuple[str, str]], term: str) -> Iterable[str]:
+        for i in range(bisect_left(entries, (term,)), len(entries)):
+            key, value = entries[i]
+            if not key.startswith(term):
+                break
+            yield value
+
+    def search(self, term: Optional[str], limit: int = 10, tag: Optional[Hashable] = None) -> List[str]:
+        """
+        Values that start with `term`, then values with a later word starting with it, then values
+        containing it anywhere else, each group in alphabetical order (an exact match comes first).
+        """
+
+        term = normalize_term(term or '')
+        results: List[str] = []
+        seen: Set[str] = set()
+
+        keys, words, infixes = self.keys, self.words, self.infixes
+        matches = chain(self._starting_with(keys, term), self._starting_with(words, term),
+                        self._starting_with(infixes, term))
+
+        for value in matches:
+            if value in seen or (tag is not None and tag not in self.tags[value]):
+                continue
+            seen.add(value)
+            results.append(value)
+            if len(results) >= limit:
+                break
+
+        return results
+
+
+class _Entry:
+    def __init__(self, index: PrefixIndex, version: int):
+        self.index = index
+        self.version = version
+        self.built_at = time.monotonic()
+
+
+class Autocomplete:
+    """
+    Lazily built PrefixIndexes for the autocomplete endpoints: project clients and vendor names
+    across all projects, and towns (tagged with their state) and states per project.
+    """
+
+    def __init__(self):
+        self.indexes: Dict[str, _Entry] = {}
+        self.project_indexes = LRUCache(AUTOCOMPLETE_MAX_PROJECTS * 2)
+        self.builds = SingleFlight()
+
+    def _get(self, cache, key: Hashable, build: Callable[[], PrefixIndex], version: int = 0,
+             max_age: float = AUTOCOMPLETE_REFRESH_SECONDS) -> PrefixIndex:
+        entry = cache.get(key)
+        if entry is not None:
+            age = time.monotonic() - entry.built_at
+            if age < max_age and (entry.version == version or age < AUTOCOMPLETE_REFRESH_SECONDS):
+                return entry.index
+
+        def rebuild() -> PrefixIndex:
+            index = build()
+            entry = _Entry(index, version)
+            if isinstance(cache, dict):
+                cache[key] = entry
+            else:
+                cache.set(key, entry)
+            return index
+
+        return self.builds.do(key, rebuild)
+
+    def clients(self, session: Session) -> PrefixIndex:
+        def build():
+            query = session.query(Project.client).filter(Project.client.isnot(None)).distinct()
+            return PrefixIndex((row.client, None) for row in query)
+
+        return self._get(self.indexes, 'clients', build)
+
+    def vendors(self, session: Session) -> PrefixIndex:
+        def build():
+            return PrefixIndex((row.name, None) for row in session.query(Vendor.name))
+
+        return self._get(self.indexes, 'vendors', build)
+
+    def towns(self, session: Session, project_id: int, version: int) -> PrefixIndex:
+        def build():
+            query = session.query(Submission.town, Submission.state)
+            query = query.filter(Submission.project_id == project_id, Submission.town.isnot(None)).distinct()
+            return PrefixIndex((row.town, row.state) for row in query)
+
+        return self._get(self.project_indexes, ('towns', project_id), build, version, AUTOCOMPLETE_MAX_AGE_SECONDS)
+
+    def states(self, session: Session, project_id: int, version: int) -> PrefixIndex:
+        def build():
+            query = session.query(Submission.state)
+            query = query.filter(Submission.project_id == project_id, Submission.state.isnot(None)).distinct()
+            return PrefixIndex((row.state, None) for row in query)
+
+        return self._get(self.project_indexes, ('states', project_id), build, version, AUTOCOMPLETE_MAX_AGE_SECONDS)
+
+    # Called after the writes commit. Indexes that haven't been built yet will load the values anyway.
+
+    def add_client(self, client: Optional[str]) -> None:
+        entry = self.indexes.get('clients')
+        if entry is not None and client:
+            entry.index.add(client)
+
+    def add_vendor(self, name: str) -> None:
+        entry = self.indexes.get('vendors')
+        if entry is not None:
+            entry.index.add(name)
+
+    def add_submissions(self, project_id: int, submissions: Iterable[dict]) -> None:
+        towns = self.project_indexes.get(('towns', project_id))
+        states = self.project_indexes.get(('states', project_id))
+        if towns is None and states is None:
+            return
+
+        submissions = list(submissions)
+        if towns is not None:
+            towns.index.add_many((submission['town'], submission.get('state'))
+                                 for submission in submissions if submission.get('town'))
+        if states is not None:
+            states.index.add_many((submission['state'], None)
+                                  for submission in submissions if submission.get('state'))
+
+
+autocomplete = Autocomplete()
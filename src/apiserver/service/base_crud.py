@@ -1,7 +1,10 @@
-from typing import Any, Dict, Generic, List, Optional, Type, TypeVar, Union
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Type, TypeVar, Union
 
-from fastapi.encoders import jsonable_encoder
 from fastapi_sqlalchemy import db
+from pydantic import BaseModel
+from sqlalchemy import Boolean, case, cast, column, delete, insert, select, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Row
 
 from apiserver.db.base_class import Base
 
@@ -9,8 +12,16 @@ ModelType = TypeVar("ModelType", bound=Base)
 
 
 class CRUDBase:
+    """
+    Every write is a single statement that uses RETURNING to hand back only the columns the caller
+    asks for (all columns by default). Nothing is refreshed or re-encoded after the write, and the
+    returned rows support attribute access like ORM objects do, so they can be returned from route
+    handlers directly.
+    """
+
     def __init__(self, model: ModelType):
         self.model = model
+        self.table = model.__table__
 
     def get(self, id: Any) -> Optional[ModelType]:
         return db.session.query(self.model).filter(self.model.id == id).first()
@@ -18,32 +29,167 @@ class CRUDBase:
     def get_multi(self, *, skip: int = 0, limit: int = 100) -> List[ModelType]:
         return db.session.query(self.model).offset(skip).limit(limit).all()
 
-    def create(self, obj_in: ModelType) -> ModelType:
-        obj_in_data = jsonable_encoder(obj_in)
-        db_obj = self.model(**obj_in_data)  # type: ignore
-        db.session.add(db_obj)
+    def columns_for(self, schema: Type[BaseModel], *extra: str) -> List[Any]:
+        """Table columns backing the fields of a response schema, plus any `extra` column names."""
+        names = [*schema.model_fields, *extra]
+        return [self.table.c[name] for name in dict.fromkeys(names) if name in self.table.c]
+
+    def _returning(self, returning: Optional[Sequence[Any]]) -> List[Any]:
+        return list(returning) if returning is not None else list(self.table.c)
+
+    def _values(self, obj_in: Union[BaseModel, Dict[str, Any]], exclude_unset: bool = False) -> Dict[str, Any]:
+        if isinstance(obj_in, dict):
+            return obj_in
+        return obj_in.model_dump(exclude_unset=exclude_unset)
+
+    def _columns_only(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in data.items() if key in self.table.c}
+
+    def create(self, obj_in: Union[BaseModel, Dict[str, Any]], *,
+               returning: Optional[Sequence[Any]] = None) -> Row:
+        stmt = insert(self.table).values(**self._values(obj_in)).returning(*self._returning(returning))
+        row = db.session.execute(stmt).one()
         db.session.commit()
-        db.session.refresh(db_obj)
-        return db_obj
+        return row
 
     def update(
-        self, *, db_obj: ModelType, obj_in: Union[ModelType, Dict[str, Any]]
-    ) -> ModelType:
-        obj_data = jsonable_encoder(db_obj)
-        if isinstance(obj_in, dict):
-            update_data = obj_in
-        else:
-            update_data = obj_in.dict(exclude_unset=True)
-        for field in obj_data:
-            if field in update_data:
-                setattr(db_obj, field, update_data[field])
-        db.session.add(db_obj)
+        self, *, obj_in: Union[BaseModel, Dict[str, Any]], db_obj: Optional[ModelType] = None, id: Any = None,
+        returning: Optional[Sequence[Any]] = None
+    ) -> Optional[Row]:
+        """
+        Update the row identified by `id` (or `db_obj.id`). Fields that are not columns are ignored,
+        and for schemas only the fields that were explicitly set are written.
+
+        :return: the updated row, or None if it does not exist.
+        """
+
+        if id is None:
+            id = db_obj.id
+
+        update_data = self._columns_only(self._values(obj_in, exclude_unset=True))
+        columns = self._returning(returning)
+
+        if not update_data:
+            return db.session.execute(select(*columns).where(self.table.c.id == id)).first()
+
+        stmt = update(self.table).where(self.table.c.id == id).values(**update_data).returning(*columns)
+        row = db.session.execute(stmt).first()
         db.session.commit()
-        db.session.refresh(db_obj)
-        return db_obj
+        return row
 
-    def delete(self, id: int) -> ModelType:
-        obj = db.session.query(self.model).get(id)
-        db.session.delete(obj)
+    def delete(self, id: int, *, returning: Optional[Sequence[Any]] = None) -> Optional[Row]:
+        stmt = delete(self.table).where(self.table.c.id == id).returning(*self._returning(returning))
+        row = db.session.execute(stmt).first()
         db.session.commit()
-        return obj
+        return row
+
+    def create_many(self, objs_in: Iterable[Union[BaseModel, Dict[str, Any]]], *,
+                    returning: Optional[Sequence[Any]] = None, commit: bool = True) -> List[Row]:
+        """
+        Insert many rows with one batched INSERT ... RETURNING. Rows come back in input order.
+        Every row must set the same columns.
+        """
+
+        rows = [self._values(obj_in) for obj_in in objs_in]
+        if not rows:
+            return []
+        if any(row.keys() != rows[0].keys() for row in rows):
+            raise ValueError('All rows passed to create_many must set the same columns')
+
+        stmt = insert(self.table).returning(*self._returning(returning), sort_by_parameter_order=True)
+        result = db.session.execute(stmt, rows).all()
+        if commit:
+            db.session.commit()
+        return result
+
+    def update_many(self, changes: Dict[Any, Dict[str, Any]], *, key: str = 'id', where: Sequence[Any] = (),
+                    extra_values: Optional[Dict[str, Any]] = None, returning: Optional[Sequence[Any]] = None,
+                    commit: bool = True) -> List[Row]:
+        """
+        Apply per-row changes with a single UPDATE ... FROM (VALUES ...) statement.
+
+        Rows may change different columns: every column touched anywhere in the batch gets a value
+        column and a `set_<column>` flag, and rows that did not touch a column keep their current
+        value. `extra_values` are applied to every matched row, `where` further restricts the rows.
+
+        :param changes: value of `key` -> {column: new value}
+        :return: the updated rows, `key` only unless `returning` is given.
+        """
+
+        if not changes:
+            return []
+
+        key_column = self.table.c[key]
+        changes = {row_key: self._columns_only(row_changes) for row_key, row_changes in changes.items()}
+        columns = sorted({name for row_changes in changes.values() for name in row_changes})
+
+        value_columns = [column(key, key_column.type)]
+        value_columns += [column(name, self.table.c[name].type) for name in columns]
+        value_columns += [column(f'set_{name}', Boolean) for name in columns]
+
+        rows = []
+        for row_key, row_changes in changes.items():
+            rows.append((row_key,
+                         *[row_changes.get(name) for name in columns],
+                         *[name in row_changes for name in columns]))
+
+        changes_values = values(*value_columns, name='changes').data(rows)
+
+        # VALUES columns that only hold NULLs or bare literals come back as text, so cast explicitly
+        set_values = {
+            name: case((changes_values.c[f'set_{name}'], cast(changes_values.c[name], self.table.c[name].type)),
+                       else_=self.table.c[name])
+            for name in columns
+        }
+        set_values.update(extra_values or {})
+
+        stmt = update(self.table).where(key_column == changes_values.c[key], *where)
+        if set_values:
+            stmt = stmt.values(**set_values)
+        else:
+            stmt = stmt.values({key_column: key_column})
+        stmt = stmt.returning(*(returning if returning is not None else [key_column]))
+
+        result = db.session.execute(stmt).all()
+        if commit:
+            db.session.commit()
+        return result
+
+    def upsert_many(self, objs_in: Iterable[Union[BaseModel, Dict[str, Any]]], *, index_elements: Sequence[str],
+                    update_columns: Optional[Sequence[str]] = None, where: Any = None,
+                    returning: Optional[Sequence[Any]] = None, commit: bool = True) -> List[Row]:
+        """
+        INSERT ... ON CONFLICT (`index_elements`) DO UPDATE for many rows in one batched statement.
+
+        `update_columns` defaults to every column set by the rows except the conflict target. Pass
+        `where` to skip updating conflicting rows (referencing `self.excluded(...)` for the incoming
+        values); skipped rows are not returned. Returned rows are not in input order.
+        """
+
+        rows = [self._values(obj_in) for obj_in in objs_in]
+        if not rows:
+            return []
+        if any(row.keys() != rows[0].keys() for row in rows):
+            raise ValueError('All rows passed to upsert_many must set the same columns')
+
+        if update_columns is None:
+            update_columns = [name for name in rows[0] if name not in index_elements]
+
+        stmt = pg_insert(self.table)
+        set_ = {name: stmt.excluded[name] for name in update_columns}
+        # onupdate defaults (e.g. updated_at) are not applied to ON CONFLICT updates unless set explicitly
+        for table_column in self.table.c:
+            if table_column.onupdate is not None and table_column.name not in set_:
+                set_[table_column.name] = table_column.onupdate.arg
+
+        stmt = stmt.on_conflict_do_update(index_elements=index_elements, set_=set_, where=where)
+        stmt = stmt.returning(*self._returning(returning))
+
+        result = db.session.execute(stmt, rows).all()
+        if commit:
+            db.session.commit()
+        return result
+
+    def excluded(self, name: str) -> Any:
+        """The incoming value of column `name` inside an upsert_many `where` clause."""
+        return pg_insert(self.table).excluded[name]
@@ -0,0 +1,202 @@
+import math
+import os
+from collections import defaultdict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+
+from apiserver.models import Submission, Vendor
+
+# Two units closer than this are reported as possible duplicates of the same billboard
+DUPLICATE_DISTANCE_METERS = float(os.environ.get('DUPLICATE_DISTANCE_METERS', 25))
+
+EARTH_RADIUS_METERS = 6371008.8
+METERS_PER_DEGREE_LAT = 111320.0
+
+
+def haversine_meters(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    d_phi = phi2 - phi1
+    d_lambda = math.radians(lon2 - lon1)
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(math.sqrt(a), 1.0))
+
+
+def degree_deltas(latitude: float, distance: float) -> Tuple[float, float]:
+    """
+    Latitude and longitude spans (in degrees) that contain every point within `distance` meters
+    of a point at `latitude`. The longitude span uses the poleward edge, so it never comes up short.
+    """
+
+    d_lat = distance / METERS_PER_DEGREE_LAT
+    poleward = min(abs(latitude) + d_lat, 89.9)
+    d_lon = distance / (METERS_PER_DEGREE_LAT * math.cos(math.radians(poleward)))
+    return d_lat, d_lon
+
+
+def normalize_geopath_id(geopath_id: Optional[str]) -> Optional[str]:
+    if geopath_id is None:
+        return None
+    return geopath_id.strip() or None
+
+
+class GridIndex:
+    """
+    Spatial hash of points on a grid of roughly `distance`-sized cells, so finding the neighbours of
+    a point only looks at a few cells instead of every point.
+
+    Rows are `distance` tall in latitude. Cells within a row are as wide in longitude as
+    `distance` is at the row's poleward edge, so they are never narrower than `distance`.
+    Longitudes are not wrapped around the antimeridian.
+    """
+
+    def __init__(self, distance: float):
+        self.distance = distance
+        self.d_lat = distance / METERS_PER_DEGREE_LAT
+        self.cells: Dict[Tuple[int, int], List[Tuple[float, float, Any]]] = defaultdict(list)
+
+    def _row(self, latitude: float) -> int:
+        return math.floor(latitude / self.d_lat)
+
+    def _width(self, row: int) -> float:
+        return degree_deltas(max(abs(row * self.d_lat), abs((row + 1) * self.d_lat)), self.distance)[1]
+
+    def add(self, latitude: float, longitude: float, item: Any) -> None:
+        row = self._row(latitude)
+        self.cells[(row, math.floor(longitude / self._width(row)))].append((latitude, longitude, item))
+
+    def near(self, latitude: float, longitude: float) -> Iterable[Tuple[Any, float]]:
+        """Yield (item, distance in meters) for every indexed point within `distance`."""
+
+        _, d_lon = degree_deltas(latitude, self.distance)
+        row = self._row(latitude)
+        for r in (row - 1, row, row + 1):
+            width = self._width(r)
+            for c in range(math.floor((longitude - d_lon) / width), math.floor((longitude + d_lon) / width) + 1):
+                for other_latitude, other_longitude, item in self.cells.get((r, c), ()):
+                    meters = haversine_meters(latitude, longitude, other_latitude, other_longitude)
+                    if meters <= self.distance:
+                        yield item, meters
+
+
+def find_duplicate_pairs(units: List[Dict[str, Any]], distance: float = DUPLICATE_DISTANCE_METERS
+                         ) -> Dict[Tuple[int, int], Dict[str, Any]]:
+    """
+    Pairs of units that share a geopath_id or are within `distance` meters of each other.
+
+    :param units: dicts with geopath_id, latitude and longitude.
+    :return: (index, index) -> {'reasons': set, 'distance_meters': float or None}, each pair once.
+    """
+
+    pairs: Dict[Tuple[int, int], Dict[str, Any]] = {}
+
+    def add_pair(i: int, j: int, reason: str, meters: Optional[float] = None):
+        pair = pairs.setdefault((min(i, j), max(i, j)), {'reasons': set(), 'distance_meters': None})
+        pair['reasons'].add(reason)
+        if meters is not None:
+            pair['distance_meters'] = meters
+
+    by_geopath: Dict[str, List[int]] = defaultdict(list)
+    grid = GridIndex(distance)
+
+    for i, unit in enumerate(units):
+        geopath_id = normalize_geopath_id(unit.get('geopath_id'))
+        if geopath_id is not None:
+            for j in by_geopath[geopath_id]:
+                add_pair(j, i, 'geopath_id')
+            by_geopath[geopath_id].append(i)
+
+        latitude, longitude = unit.get('latitude'), unit.get('longitude')
+        if latitude is not None and longitude is not None:
+            for j, meters in grid.near(latitude, longitude):
+                add_pair(j, i, 'distance', meters)
+            grid.add(latitude, longitude, i)
+
+    return pairs
+
+
+def duplicate_groups(units: List[Dict[str, Any]], distance: float = DUPLICATE_DISTANCE_METERS
+                     ) -> List[Dict[str, Any]]:
+    """
+    Connected groups of possible duplicates, largest first. A unit that matches two others puts
+    all three in one group, even if those two do not match each other.
+    """
+
+    pairs = find_duplicate_pairs(units, distance)
+
+    parent = list(range(len(units)))
+
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        parent[find(i)] = find(j)
+
+    groups: Dict[int, Dict[str, Any]] = {}
+    for (i, j), pair in pairs.items():
+        group = groups.setdefault(find(i), {'members': set(), 'matched_by': set(), 'max_distance_meters': None})
+        group['members'].update((i, j))
+        group['matched_by'].update(pair['reasons'])
+        if pair['distance_meters'] is not None:
+            group['max_distance_meters'] = max(group['max_distance_meters'] or 0, pair['distance_meters'])
+
+    result = []
+    for group in groups.values():
+        result.append({
+            'units': [units[i] for i in sorted(group['members'])],
+            'matched_by': sorted(group['matched_by']),
+            'max_distance_meters': group['max_distance_meters'],
+        })
+    result.sort(key=lambda group: len(group['units']), reverse=True)
+    return result
+
+
+def project_duplicate_groups(session: Session, project_id: int,
+                             distance: float = DUPLICATE_DISTANCE_METERS) -> List[Dict[str, Any]]:
+    query = session.query(Submission.unit_id, Vendor.name.label('vendor'), Submission.geopath_id,
+                          Submission.latitude, Submission.longitude)
+    query = query.join(Submission.vendor).filter(Submission.project_id == project_id)
+    query = query.order_by(Submission.id)
+
+    units = [row._asdict() for row in query.all()]
+    return duplicate_groups(units, distance)
+
+
+def find_possible_duplicates(session: Session, project_id: int, unit_id: str, geopath_id: Optional[str],
+                             latitude: Optional[float], longitude: Optional[float],
+                             distance: float = DUPLICATE_DISTANCE_METERS) -> List[str]:
+    """
+    unit_ids of the project's other submissions that share `geopath_id` or lie within `distance`
+    meters. Narrowed down in SQL by exact geopath_id and a lat/lon bounding box, so a single
+    submission is checked without loading the project.
+    """
+
+    geopath_id = normalize_geopath_id(geopath_id)
+
+    criteria = []
+    if geopath_id is not None:
+        criteria.append(Submission.geopath_id == geopath_id)
+    if latitude is not None and longitude is not None:
+        d_lat, d_lon = degree_deltas(latitude, distance)
+        criteria.append(and_(Submission.latitude.between(latitude - d_lat, latitude + d_lat),
+                             Submission.longitude.between(longitude - d_lon, longitude + d_lon)))
+    if not criteria:
+        return []
+
+    query = session.query(Submission.unit_id, Submission.geopath_id, Submission.latitude, Submission.longitude)
+    query = query.filter(Submission.project_id == project_id, Submission.unit_id != unit_id, or_(*criteria))
+
+    duplicates = []
+    for row in query.all():
+        if geopath_id is not None and normalize_geopath_id(row.geopath_id) == geopath_id:
+            duplicates.append(row.unit_id)
+        elif latitude is not None and longitude is not None and row.latitude is not None \
+                and row.longitude is not None \
+                and haversine_meters(latitude, longitude, row.latitude, row.longitude) <= distance:
+            duplicates.append(row.unit_id)
+
+    return sorted(duplicates)
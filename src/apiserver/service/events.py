@@ -0,0 +1,234 @@
+import asyncio
+import json
+import os
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+from fastapi_sqlalchemy import db
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+from apiserver.models import Submission
+
+EVENTS_CHANNEL = 'project_events'
+SSE_HEARTBEAT_SECONDS = float(os.environ.get('SSE_HEARTBEAT_SECONDS', 15))
+SSE_QUEUE_SIZE = int(os.environ.get('SSE_QUEUE_SIZE', 100))
+# NOTIFY payloads are limited to 8000 bytes, larger batches are sent as a count only
+EVENT_MAX_UNIT_IDS = 100
+
+# event types that change the numbers on the stats panel
+STATS_EVENTS = {'submission_upserted', 'submission_edited', 'selection_changed'}
+
+
+def notify_project_event(session: Session, project_id: int, type: str, unit_ids: Optional[List[str]] = None,
+                         **data: Any) -> None:
+    """
+    Queue a change event for the project on the session's transaction. Postgres only delivers it to
+    listeners once the transaction commits, and drops it on rollback, so call this before the write
+    is committed.
+    """
+
+    payload = {'project_id': project_id, 'type': type, **data}
+    if unit_ids is not None:
+        payload['count'] = len(unit_ids)
+        if len(unit_ids) <= EVENT_MAX_UNIT_IDS:
+            payload['unit_ids'] = unit_ids
+
+    session.execute(func.pg_notify(EVENTS_CHANNEL, json.dumps(payload, default=str)).select())
+
+
+class Subscription:
+    def __init__(self, project_id: int, loop: asyncio.AbstractEventLoop):
+        self.project_id = project_id
+        self.loop = loop
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SSE_QUEUE_SIZE)
+
+    def put(self, event: Dict[str, Any]) -> None:
+        """Called on the event loop. A client too slow to keep up is told to reload instead."""
+
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait({'project_id': self.project_id, 'type': 'resync'})
+
+
+class EventBroker:
+    """
+    One LISTEN connection per process, fanning project events out to the SSE subscribers of this
+    process. Every process with subscribers listens, so a change made through any worker (or the
+    CLI) reaches every stream.
+
+    Also counts events per project: `version(project_id)` changes whenever the project's data
+    does, which makes it usable in cache keys.
+    """
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.subscriptions: Dict[int, Set[Subscription]] = {}
+        self.versions: Dict[int, int] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+        # stats are computed once per process and event, not once per subscriber
+        self.stats_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='event-stats')
+        self.stats_pending: Set[int] = set()
+
+    def version(self, project_id: int) -> int:
+        return self.versions.get(project_id, 0)
+
+    def subscribe(self, project_id: int) -> Subscription:
+        self.start()
+        subscription = Subscription(project_id, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions.setdefault(project_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.project_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.project_id, None)
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.listen, name='event-broker', daemon=True)
+                self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.stats_pool.shutdown(wait=False)
+
+    def listen(self) -> None:
+        while not self.stopping.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                print(f'Event listener disconnected: {e}')
+                # something may have been missed while reconnecting
+                self.publish_all({'type': 'resync'})
+                self.stopping.wait(1)
+
+    def _listen(self) -> None:
+        cargs, cparams = self.engine.dialect.create_connect_args(self.engine.url)
+        connection = self.engine.dialect.dbapi.connect(*cargs, **cparams)
+        try:
+            connection.autocommit = True
+            with connection.cursor() as cursor:
+                cursor.execute(f'LISTEN {EVENTS_CHANNEL}')
+
+            while not self.stopping.is_set():
+                if select.select([connection], [], [], 5) == ([], [], []):
+                    continue
+
+                connection.poll()
+                while connection.notifies:
+                    notify = connection.notifies.pop(0)
+                    self.dispatch(json.loads(notify.payload))
+        finally:
+            connection.close()
+
+    def dispatch(self, event: Dict[str, Any]) -> None:
+        project_id = event['project_id']
+        with self.lock:
+            self.versions[project_id] = self.versions.get(project_id, 0) + 1
+            event['version'] = self.versions[project_id]
+            has_subscribers = project_id in self.subscriptions
+
+        if not has_subscribers:
+            return
+
+        self.publish(project_id, event)
+
+        if event['type'] in STATS_EVENTS:
+            with self.lock:
+                if project_id in self.stats_pending:
+                    return
+                self.stats_pending.add(project_id)
+            self.stats_pool.submit(self.publish_stats, project_id)
+
+    def publish(self, project_id: int, event: Dict[str, Any]) -> None:
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(project_id, ()))
+        for subscription in subscriptions:
+            subscription.loop.call_soon_threadsafe(subscription.put, event)
+
+    def publish_all(self, event: Dict[str, Any]) -> None:
+        with self.lock:
+            project_ids = list(self.subscriptions)
+        for project_id in project_ids:
+            self.publish(project_id, {**event, 'project_id': project_id})
+
+    def publish_stats(self, project_id: int) -> None:
+        # events that arrive while this runs are covered, the numbers are read after they committed
+        with self.lock:
+            self.stats_pending.discard(project_id)
+
+        from apiserver.service.api_crud import submission_crud
+
+        try:
+            with db():
+                stats = submission_crud.selection_stats(project_id)
+                stats['sites'] = db.session.query(func.count(Submission.id)).filter(
+                    Submission.project_id == project_id).scalar()
+        except Exception as e:
+            print(f'Unable to compute stats for project {project_id}: {e}')
+            return
+
+        self.publish(project_id, {'project_id': project_id, 'type': 'stats', 'version': self.version(project_id),
+                                  **stats})
+
+
+def format_sse(event: Dict[str, Any]) -> str:
+    lines = []
+    if 'version' in event:
+        lines.append(f"id: {event['version']}")
+    lines.append(f"event: {event['type']}")
+    lines.append(f"data: {json.dumps(event, default=str)}")
+    return '\n'.join(lines) + '\n\n'
+
+
+async def stream_project_events(broker: EventBroker, project_id: int):
+    """Async generator of SSE frames for one client, with comment heartbeats to keep proxies from timing out."""
+
+    subscription = broker.subscribe(project_id)
+    try:
+        yield 'retry: 3000\n\n'
+        yield format_sse({'project_id': project_id, 'type': 'subscribed', 'version': broker.version(project_id)})
+
+        while True:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=SSE_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield f': heartbeat {int(time.time())}\n\n'
+                continue
+
+            yield format_sse(event)
+    finally:
+        broker.unsubscribe(subscription)
+
+
+def get_event_broker() -> EventBroker:
+    global _broker
+
+    if _broker is None:
+        from apiserver.db.session import engine
+
+        _broker = EventBroker(engine)
+
+    return _broker
+
+
+def stop_event_broker() -> None:
+    if _broker is not None:
+        _broker.stop()
+
+
+_broker: Optional[EventBroker] = None
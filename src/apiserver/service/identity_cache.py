@@ -0,0 +1,79 @@
+import os
+from typing import Optional
+
+from fastapi_sqlalchemy import db
+
+from apiserver.core.cache import LRUCache
+from apiserver.models import Project, Vendor, ProjectVendor
+
+
+class IdentityCache:
+    """
+    Process-local cache of identifiers that almost never change once created:
+
+    - wilkins_id -> project id
+    - vendor name -> vendor id
+    - (project id, vendor id) -> project/vendor link exists
+
+    Lookups fall through to the database on a miss. Only positive results are cached, so a project
+    or vendor created by another worker is picked up on the next lookup. Create paths write through
+    with `set_*`/`add_*` and update paths drop entries with `invalidate_*`.
+    """
+
+    def __init__(self, maxsize: int):
+        self.projects = LRUCache(maxsize)
+        self.vendors = LRUCache(maxsize)
+        self.project_vendors = LRUCache(maxsize)
+
+    def get_project_id(self, wilkins_id: str) -> Optional[int]:
+        project_id = self.projects.get(wilkins_id)
+        if project_id is None:
+            project_id = db.session.query(Project.id).filter(Project.wilkins_id == wilkins_id).scalar()
+            if project_id is not None:
+                self.projects.set(wilkins_id, project_id)
+        return project_id
+
+    def set_project_id(self, wilkins_id: str, project_id: int) -> None:
+        self.projects.set(wilkins_id, project_id)
+
+    def invalidate_project(self, wilkins_id: str) -> None:
+        self.projects.pop(wilkins_id)
+
+    def get_vendor_id(self, name: str) -> Optional[int]:
+        vendor_id = self.vendors.get(name)
+        if vendor_id is None:
+            vendor_id = db.session.query(Vendor.id).filter(Vendor.name == name).scalar()
+            if vendor_id is not None:
+                self.vendors.set(name, vendor_id)
+        return vendor_id
+
+    def set_vendor_id(self, name: str, vendor_id: int) -> None:
+        self.vendors.set(name, vendor_id)
+
+    def invalidate_vendor(self, name: str) -> None:
+        self.vendors.pop(name)
+
+    def project_vendor_exists(self, project_id: int, vendor_id: int) -> bool:
+        key = (project_id, vendor_id)
+        if key in self.project_vendors:
+            return True
+
+        query = db.session.query(ProjectVendor.id)
+        query = query.filter(ProjectVendor.project_id == project_id,
+                             ProjectVendor.vendor_id == vendor_id)
+        if query.first() is None:
+            return False
+
+        self.project_vendors.set(key, True)
+        return True
+
+    def add_project_vendor(self, project_id: int, vendor_id: int) -> None:
+        self.project_vendors.set((project_id, vendor_id), True)
+
+    def clear(self) -> None:
+        self.projects.clear()
+        self.vendors.clear()
+        self.project_vendors.clear()
+
+
+identity_cache = IdentityCache(maxsize=int(os.environ.get('IDENTITY_CACHE_SIZE', 4096)))
@@ -0,0 +1,133 @@
+import io
+import os
+import posixpath
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+
+from sqlalchemy import bindparam, func, update
+from sqlalchemy.orm import Session
+
+from apiserver.core.storage import get_image_store
+from apiserver.models import Submission
+
+THUMBNAIL_SIZE = int(os.environ.get('THUMBNAIL_SIZE', 320))
+THUMBNAIL_QUALITY = int(os.environ.get('THUMBNAIL_QUALITY', 80))
+
+# Bounds how many images are decoded at once, independent of how many requests are in flight.
+thumbnail_pool = ThreadPoolExecutor(max_workers=int(os.environ.get('THUMBNAIL_WORKERS', 4)),
+                                    thread_name_prefix='thumbnail')
+
+
+class InvalidImageError(ValueError):
+    pass
+
+
+def thumbnail_name(image_id: str) -> str:
+    return f'thumbnails/{image_id}.jpg'
+
+
+def make_thumbnail(stream: BinaryIO, size: int = THUMBNAIL_SIZE) -> bytes:
+    """
+    Render a `size` x `size` JPEG thumbnail, center-cropped so every grid cell has the same shape.
+    """
+
+    # Pillow is only needed for uploads and backfills, keep it out of API start-up
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(stream) as image:
+            # JPEGs can be downscaled by the decoder, which is far cheaper than decoding at full size
+            image.draft('RGB', (size, size))
+            image = ImageOps.exif_transpose(image).convert('RGB')
+            thumbnail = ImageOps.fit(image, (size, size), method=Image.Resampling.LANCZOS)
+    # truncated or corrupt files fail while decoding with a plain OSError or ValueError
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise InvalidImageError(str(e) or type(e).__name__)
+
+    out = io.BytesIO()
+    thumbnail.save(out, format='JPEG', quality=THUMBNAIL_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def store_thumbnail(image_id: str, stream: BinaryIO) -> str:
+    name = thumbnail_name(image_id)
+    get_image_store().upload(name, io.BytesIO(make_thumbnail(stream)), 'image/jpeg')
+    return name
+
+
+def store_thumbnail_from_original(image_id: str) -> str:
+    original = get_image_store().download(image_id)
+    return store_thumbnail(image_id, io.BytesIO(original))
+
+
+def store_image(unit_id: str, stream: BinaryIO, filename: Optional[str] = None,
+                content_type: Optional[str] = None) -> Tuple[str, str]:
+    """
+    Store an uploaded image and its thumbnail side by side.
+
+    The thumbnail is rendered first so that files which are not images are rejected before
+    anything is written.
+
+    :return: (image_id, thumbnail_id)
+    """
+
+    extension = posixpath.splitext(filename or '')[1].lower()
+    image_id = f'submissions/{unit_id}/{uuid.uuid4().hex}{extension}'
+
+    thumbnail = thumbnail_pool.submit(make_thumbnail, stream).result()
+
+    store = get_image_store()
+    stream.seek(0)
+    store.upload(image_id, stream, content_type)
+
+    thumbnail_id = thumbnail_name(image_id)
+    store.upload(thumbnail_id, io.BytesIO(thumbnail), 'image/jpeg')
+
+    return image_id, thumbnail_id
+
+
+def generate_missing_thumbnails(session: Session, project_id: int, limit: int = 100,
+                                after_id: int = 0) -> Dict[str, Any]:
+    """
+    Generate thumbnails for up to `limit` submissions of a project that have an image but no thumbnail yet.
+
+    Originals are downloaded, resized and uploaded on the thumbnail pool; the database work stays on the
+    calling thread. Pass the returned `last_id` as `after_id` to continue past submissions that failed.
+    """
+
+    query = session.query(Submission.id, Submission.image_id)
+    query = query.filter(Submission.project_id == project_id,
+                         Submission.image_id.isnot(None),
+                         Submission.thumbnail_id.is_(None),
+                         Submission.id > after_id)
+    rows = query.order_by(Submission.id).limit(limit).all()
+
+    futures = {thumbnail_pool.submit(store_thumbnail_from_original, row.image_id): row for row in rows}
+
+    generated = []
+    failed = []
+    for future in as_completed(futures):
+        row = futures[future]
+        try:
+            generated.append({'b_id': row.id, 'thumbnail_id': future.result()})
+        except Exception as e:
+            print(f'Unable to generate thumbnail for {row.image_id}: {e}')
+            failed.append(row.image_id)
+
+    if generated:
+        stmt = update(Submission.__table__).where(Submission.__table__.c.id == bindparam('b_id'))
+        session.execute(stmt.values(thumbnail_id=bindparam('thumbnail_id')), generated)
+        session.commit()
+
+    query = session.query(func.count(Submission.id))
+    query = query.filter(Submission.project_id == project_id,
+                         Submission.image_id.isnot(None),
+                         Submission.thumbnail_id.is_(None))
+
+    return {
+        'processed': len(generated),
+        'failed': failed,
+        'remaining': query.scalar(),
+        'last_id': rows[-1].id if rows else after_id,
+    }
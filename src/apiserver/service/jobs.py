@@ -0,0 +1,175 @@
+import os
+import traceback
+from datetime import timedelta
+from typing import Any, Callable, Dict, Optional
+
+from sqlalchemy import and_, exists, func, insert, literal, or_, select, update
+from sqlalchemy.engine import Engine, Row
+from sqlalchemy.orm import Session
+
+from apiserver.models import Job, JobStatusEnum, Project
+from apiserver.service.analytics import refresh_portfolio_rollups
+from apiserver.service.images import generate_missing_thumbnails
+
+# A running job whose worker has not sent a heartbeat for this long is considered abandoned and is claimed again.
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 600))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+
+jobs_table = Job.__table__
+
+
+class JobContext:
+    """
+    Handed to job handlers so they can report progress.
+
+    Progress is written on its own short transaction so it is visible while the handler's
+    session still has work in flight, and doubles as the worker heartbeat.
+    """
+
+    def __init__(self, engine: Engine, job_id: int):
+        self.engine = engine
+        self.job_id = job_id
+
+    def progress(self, done: int, total: int) -> None:
+        progress = min(done / total, 1.0) if total else 1.0
+        stmt = update(jobs_table).where(jobs_table.c.id == self.job_id)
+        stmt = stmt.values(progress=progress, heartbeat_at=func.now())
+        with self.engine.begin() as connection:
+            connection.execute(stmt)
+
+
+def run_thumbnails_job(session: Session, params: Dict[str, Any], context: JobContext) -> Dict[str, Any]:
+    project_id = session.query(Project.id).filter(Project.wilkins_id == params['wilkins_id']).scalar()
+    if project_id is None:
+        raise ValueError(f"Project not found: {params['wilkins_id']}")
+
+    processed = 0
+    failed = []
+    after_id = 0
+    while True:
+        batch = generate_missing_thumbnails(session, project_id, limit=100, after_id=after_id)
+        if batch['last_id'] == after_id:
+            break
+
+        processed += batch['processed']
+        failed += batch['failed']
+        after_id = batch['last_id']
+        # images that failed stay without a thumbnail, so they are still part of `remaining`
+        context.progress(processed, processed + batch['remaining'])
+
+    return {'processed': processed, 'failed': failed}
+
+
+def run_rollups_job(session: Session, params: Dict[str, Any], context: JobContext) -> Dict[str, Any]:
+    return refresh_portfolio_rollups(session, full=bool(params.get('full', False)))
+
+
+JOB_HANDLERS: Dict[str, Callable[[Session, Dict[str, Any], JobContext], Optional[Dict[str, Any]]]] = {
+    'generate_thumbnails': run_thumbnails_job,
+    'refresh_portfolio_rollups': run_rollups_job,
+}
+
+
+def is_stale():
+    """Running jobs whose worker stopped sending heartbeats."""
+
+    c = jobs_table.c
+    return and_(c.status == JobStatusEnum.running,
+                c.heartbeat_at < func.now() - timedelta(seconds=JOB_STALE_SECONDS))
+
+
+def fail_abandoned_jobs(session: Session) -> int:
+    """
+    Mark stale jobs that have used up their attempts as failed, so they don't stay running forever
+    (and block `enqueue_job_once` for their kind).
+
+    :return: the number of jobs marked as failed.
+    """
+
+    c = jobs_table.c
+    stmt = update(jobs_table).where(is_stale(), c.attempts >= JOB_MAX_ATTEMPTS)
+    stmt = stmt.values(status=JobStatusEnum.failed, finished_at=func.now(),
+                       error=f'Worker lost ({JOB_MAX_ATTEMPTS} attempts)')
+
+    failed = session.execute(stmt).rowcount
+    session.commit()
+    return failed
+
+
+def enqueue_job_once(session: Session, kind: str, params: Optional[Dict[str, Any]] = None,
+                     created_by: Optional[str] = None) -> bool:
+    """
+    Queue a job of `kind` unless one is already queued or running (with a live worker).
+
+    :return: whether a job was queued.
+    """
+
+    c = jobs_table.c
+    pending = exists().where(c.kind == kind, or_(c.status == JobStatusEnum.queued,
+                                                 and_(c.status == JobStatusEnum.running, ~is_stale())))
+    values = select(literal(kind), literal(params or {}, c.params.type), literal(created_by, c.created_by.type))
+    stmt = insert(jobs_table).from_select(['kind', 'params', 'created_by'], values.where(~pending))
+
+    queued = session.execute(stmt).rowcount > 0
+    session.commit()
+    return queued
+
+
+def claim_job(session: Session, worker_id: str) -> Optional[Row]:
+    """
+    Atomically claim the oldest runnable job for `worker_id`.
+
+    FOR UPDATE SKIP LOCKED lets any number of workers poll the same table without blocking on
+    each other or handing the same job out twice. Stale jobs out of attempts are failed first.
+    """
+
+    fail_abandoned_jobs(session)
+
+    c = jobs_table.c
+    stale = and_(is_stale(), c.attempts < JOB_MAX_ATTEMPTS)
+    candidate = select(c.id).where(or_(c.status == JobStatusEnum.queued, stale))
+    candidate = candidate.order_by(c.id).limit(1).with_for_update(skip_locked=True).scalar_subquery()
+
+    stmt = update(jobs_table).where(c.id == candidate)
+    stmt = stmt.values(status=JobStatusEnum.running, worker_id=worker_id, attempts=c.attempts + 1,
+                       started_at=func.now(), heartbeat_at=func.now())
+    stmt = stmt.returning(c.id, c.kind, c.params)
+
+    job = session.execute(stmt).first()
+    session.commit()
+    return job
+
+
+def finish_job(session: Session, job_id: int, result: Optional[Dict[str, Any]] = None,
+               error: Optional[str] = None) -> None:
+    values = {
+        'status': JobStatusEnum.failed if error is not None else JobStatusEnum.succeeded,
+        'finished_at': func.now(),
+        'heartbeat_at': func.now(),
+        'result': result,
+        'error': error,
+    }
+    if error is None:
+        values['progress'] = 1.0
+
+    session.execute(update(jobs_table).where(jobs_table.c.id == job_id).values(**values))
+    session.commit()
+
+
+def run_job(session: Session, job: Row) -> None:
+    handler = JOB_HANDLERS.get(job.kind)
+    if handler is None:
+        finish_job(session, job.id, error=f'Unknown job kind: {job.kind}')
+        return
+
+    context = JobContext(session.get_bind(), job.id)
+    try:
+        result = handler(session, job.params or {}, context)
+    except Exception:
+        session.rollback()
+        print(f'Job {job.id} ({job.kind}) failed')
+        traceback.print_exc()
+        finish_job(session, job.id, error=traceback.format_exc(limit=5)[-4000:])
+        return
+
+    finish_job(session, job.id, result=result)
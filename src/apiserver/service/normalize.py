@@ -0,0 +1,159 @@
+import hashlib
+import json
+import math
+import os
+import re
+from datetime import date
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from apiserver.models import CostBasisEnum
+
+NORMALIZE_CACHE_SIZE = int(os.environ.get('NORMALIZE_CACHE_SIZE', 4096))
+
+# "$450 ea.", "1,250.00", "$1.2k", "2 faces @ $450"
+COST_RE = re.compile(r'(?<![\d.])(\$\s*)?(\d{1,3}(?:,\d{3})+|\d+)(\.\d+)?\s*(k\b)?', re.IGNORECASE)
+NO_CHARGE_RE = re.compile(r'\b(?:free|included|incl|n/c|no charge|waived)\b', re.IGNORECASE)
+
+# "2024-03-04", "3/4", "3/4/24", "Mar 4", "March 4th, 2024", but not the year of "June 2024"
+DATE_RE = re.compile(r'''
+    (?P<iso_year>\d{4})-(?P<iso_month>\d{1,2})-(?P<iso_day>\d{1,2})
+    | (?<![\d/])(?P<month>\d{1,2})/(?P<day>\d{1,2})(?:/(?P<year>\d{4}|\d{2}))?(?![\d/])
+    | \b(?P<month_name>jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]*\.?\s*
+      (?P<name_day>\d{1,2})(?:st|nd|rd|th)?(?!\d)(?:,?\s*(?P<name_year>\d{4}))?
+''', re.IGNORECASE | re.VERBOSE)
+
+MONTHS = {name: number for number, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+
+WEEKS_PER_PERIOD = {
+    CostBasisEnum.one_week_media_cost: 1,
+    CostBasisEnum.two_week_media_cost: 2,
+    CostBasisEnum.three_week_media_cost: 3,
+    CostBasisEnum.four_week_media_cost: 4,
+}
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def parse_cost(raw: str) -> Optional[float]:
+    """
+    The first $ amount in a vendor's cost text, or without one the first number, 0 for
+    "included"/"free", otherwise None.
+    """
+
+    matches = list(COST_RE.finditer(raw))
+    if not matches:
+        return 0.0 if NO_CHARGE_RE.search(raw) else None
+
+    match = next((match for match in matches if match[1]), matches[0])
+    _, whole, fraction, thousands = match.groups()
+    cost = float(whole.replace(',', '') + (fraction or ''))
+    return cost * 1000 if thousands else cost
+
+
+def _date_tokens(raw: str) -> List[Tuple[int, int, Optional[int]]]:
+    tokens = []
+    for match in DATE_RE.finditer(raw):
+        if match['iso_year']:
+            tokens.append((int(match['iso_month']), int(match['iso_day']), int(match['iso_year'])))
+        elif match['month']:
+            year = match['year']
+            if year is not None:
+                year = int(year) + 2000 if len(year) == 2 else int(year)
+            tokens.append((int(match['month']), int(match['day']), year))
+        else:
+            year = match['name_year']
+            tokens.append((MONTHS[match['month_name'][:3].lower()], int(match['name_day']),
+                           int(year) if year else None))
+    return tokens
+
+
+def _make_date(month: int, day: int, year: int) -> Optional[date]:
+    try:
+        return date(year, month, day)
+    except ValueError:
+        return None
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def parse_date_range(raw: str, default_year: int) -> Tuple[Optional[date], Optional[date]]:
+    """
+    Start and end of an availability like "Avail 3/4-4/28" or "March 4 - April 28, 2024". A date
+    without a year takes the other date's year, or `default_year`; an end that would then come
+    before the start is in the next year. A single date is the start.
+    """
+
+    tokens = _date_tokens(raw)
+    if not tokens:
+        return None, None
+
+    (start_month, start_day, start_year), end = tokens[0], tokens[1] if len(tokens) > 1 else None
+    if end is None:
+        return _make_date(start_month, start_day, start_year or default_year), None
+
+    end_month, end_day, end_year = end
+    if start_year is None and end_year is None:
+        start_year = default_year
+        end_year = start_year + 1 if (end_month, end_day) < (start_month, start_day) else start_year
+    elif start_year is None:
+        start_year = end_year - 1 if (end_month, end_day) < (start_month, start_day) else end_year
+    elif end_year is None:
+        end_year = start_year + 1 if (end_month, end_day) < (start_month, start_day) else start_year
+
+    start = _make_date(start_month, start_day, start_year)
+    if start is None:
+        return None, None
+    return start, _make_date(end_month, end_day, end_year)
+
+
+def count_periods(start: date, end: date, cost_basis: CostBasisEnum) -> Optional[int]:
+    if end < start:
+        return None
+    weeks = WEEKS_PER_PERIOD[CostBasisEnum(cost_basis)]
+    return math.ceil(((end - start).days + 1) / (7 * weeks))
+
+
+def normalize_submission(values: Dict[str, Any], today: Optional[date] = None) -> Dict[str, Any]:
+    """
+    Parsed values of a submission's raw vendor fields that it doesn't set itself: installation_cost
+    from raw_installation_cost, and availability_start/availability_end and no_of_periods from
+    raw_date. The raw fields are kept as they are.
+
+    The parsers are memoized, and vendors repeat the same few strings down a sheet, so normalizing
+    a whole sheet mostly hits the caches.
+    """
+
+    parsed = {}
+
+    raw_installation_cost = values.get('raw_installation_cost')
+    if raw_installation_cost and values.get('installation_cost') is None:
+        installation_cost = parse_cost(raw_installation_cost)
+        if installation_cost is not None:
+            parsed['installation_cost'] = installation_cost
+
+    raw_date = values.get('raw_date')
+    if raw_date and values.get('availability_start') is None and values.get('availability_end') is None:
+        start, end = parse_date_range(raw_date, (today or date.today()).year)
+        if start is not None:
+            parsed['availability_start'] = start
+        if end is not None:
+            parsed['availability_end'] = end
+
+        if start is not None and end is not None and values.get('no_of_periods') is None:
+            cost_basis = values.get('cost_basis') or CostBasisEnum.four_week_media_cost
+            no_of_periods = count_periods(start, end, cost_basis)
+            if no_of_periods is not None:
+                parsed['no_of_periods'] = no_of_periods
+
+    return parsed
+
+
+def content_hash(values: Dict[str, Any]) -> bytes:
+    """
+    Digest of the fields a sheet row sets, after parsing, stored with the submission so that
+    re-posting an unchanged row can skip the write. Which fields are set is part of the digest, as
+    unset fields leave the stored values alone.
+    """
+
+    payload = json.dumps(sorted(values.items()), default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
@@ -0,0 +1,114 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from enum import Enum
+from typing import List, Optional
+
+PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', 60))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+PROFILE_TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', 10))
+
+
+class ProfileFormat(str, Enum):
+    json = "json"
+    # one "frame;frame;frame count" line per stack, for flamegraph.pl, speedscope, etc.
+    collapsed = "collapsed"
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+# a worker runs one profile at a time, samplers would otherwise profile each other
+profile_lock = threading.Lock()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})'
+
+
+def sample_stacks(seconds: float, interval: float) -> Counter:
+    """
+    Samples the stacks of all other threads of the process every `interval` seconds. Only reads
+    `sys._current_frames()`, so the threads being profiled don't slow down, apart from the GIL
+    the sampler takes while walking their frames.
+
+    :return: counts of the collapsed stacks, root frame first and prefixed with the thread name.
+    """
+
+    own_id = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_id:
+                continue
+
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+
+            if thread_id not in names:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames.append(names.get(thread_id, str(thread_id)).replace(';', ':'))
+            stacks[';'.join(reversed(frames))] += 1
+
+        time.sleep(interval)
+
+    return stacks
+
+
+def top_allocations(snapshot: tracemalloc.Snapshot, limit: int) -> List[dict]:
+    snapshot = snapshot.filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ])
+    return [{
+        'location': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+        'size': stat.size,
+        'count': stat.count,
+    } for stat in snapshot.statistics('lineno')[:limit]]
+
+
+def profile(seconds: float, interval_ms: float = PROFILE_INTERVAL_MS, allocations: int = 0) -> dict:
+    """
+    Profiles this worker process for `seconds`: CPU by sampling the stacks of its threads, and with
+    `allocations`, the top that many lines by memory allocated (and still held) while profiling.
+    tracemalloc slows allocations down noticeably, so it is only on for the duration of the profile.
+
+    :raises ProfilerBusyError: when a profile is already running.
+    """
+
+    if not profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError()
+
+    started_tracemalloc = False
+    try:
+        if allocations and not tracemalloc.is_tracing():
+            tracemalloc.start(PROFILE_TRACEMALLOC_FRAMES)
+            started_tracemalloc = True
+
+        stacks = sample_stacks(min(seconds, PROFILE_MAX_SECONDS), interval_ms / 1000)
+
+        top: Optional[List[dict]] = None
+        if allocations:
+            top = top_allocations(tracemalloc.take_snapshot(), allocations)
+    finally:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        profile_lock.release()
+
+    return {
+        'pid': os.getpid(),
+        'seconds': min(seconds, PROFILE_MAX_SECONDS),
+        'samples': sum(stacks.values()),
+        'collapsed': ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common()),
+        'allocations': top,
+    }
@@ -0,0 +1,41 @@
+from typing import Any, Dict, Optional, Sequence
+
+
+def estimate_reach_frequency(reach: Sequence[Optional[float]], frequency: Sequence[Optional[float]]) -> Dict[str, Any]:
+    """
+    Campaign 4-week reach and average frequency of a set of units from their own 4-week reach (a
+    percentage of the A18+ population) and frequency, with the Sainsbury model: people are assumed to
+    see each unit independently of the others, so the share who see none of them is the product of
+    each unit's (1 - reach).
+
+    Gross rating points are the sum of reach * frequency. The campaign frequency is GRPs spread over
+    the people reached. Units without a reach are left out. A unit without a frequency counts as
+    reaching its audience once.
+
+    :param reach: reach of each unit.
+    :param frequency: frequency of each unit, in the same order.
+    :return: reach (%), frequency and grps, None when no unit has a reach.
+    """
+
+    # imported here rather than at module level, numpy is slow to import
+    import numpy as np
+
+    reach = np.array(reach, dtype=np.float64)
+    frequency = np.array(frequency, dtype=np.float64)
+    known = ~np.isnan(reach)
+    if not known.any():
+        return {'reach': None, 'frequency': None, 'grps': None}
+
+    reach = np.clip(reach[known], 0, 100) / 100
+    frequency = np.nan_to_num(frequency[known], nan=1.0)
+
+    # log1p keeps the product accurate across thousands of small reaches
+    with np.errstate(divide='ignore'):
+        campaign_reach = -np.expm1(np.log1p(-reach).sum())
+    grps = float((reach * frequency).sum() * 100)
+
+    return {
+        'reach': float(campaign_reach * 100),
+        'frequency': grps / (campaign_reach * 100) if campaign_reach > 0 else None,
+        'grps': grps,
+    }
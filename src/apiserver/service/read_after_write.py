@@ -0,0 +1,58 @@
+import os
+from datetime import timedelta
+from typing import Hashable
+
+from sqlalchemy import exists, func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from apiserver.core.cache import ExpiringSet
+from apiserver.db.session import engine, replica_engine
+from apiserver.models import RecentWrite
+
+# Users who wrote within the last READ_AFTER_WRITE_SECONDS read from the primary, so they see their
+# own changes even while the replica is catching up (and aren't handed a coalesced read).
+READ_AFTER_WRITE_SECONDS = float(os.environ.get('READ_AFTER_WRITE_SECONDS', 5))
+
+recent_writes_table = RecentWrite.__table__
+
+# Writes seen by this process, so its own writers' reads skip the lookup. Without a replica, reads only
+# need to avoid coalescing, which is per process too, so this is all that is kept and checked.
+local_writers = ExpiringSet(ttl=READ_AFTER_WRITE_SECONDS,
+                            maxsize=int(os.environ.get('RECENT_WRITERS_CACHE_SIZE', 4096)))
+
+
+def record_write(user_id: Hashable) -> None:
+    """
+    Start or renew the user's read-after-write window for every worker. Runs on its own short
+    autocommit transaction, so other workers see it before the write's response is sent. Only
+    recorded in this process when there is no replica.
+    """
+
+    local_writers.add(user_id)
+    if replica_engine is None:
+        return
+
+    c = recent_writes_table.c
+    stmt = insert(recent_writes_table).values(user_id=str(user_id))
+    stmt = stmt.on_conflict_do_update(index_elements=[c.user_id], set_={'updated_at': func.now()})
+    with engine.begin() as connection:
+        connection.execute(stmt)
+
+
+def wrote_recently(user_id: Hashable) -> bool:
+    """
+    Whether the user wrote through any worker in the last READ_AFTER_WRITE_SECONDS, or without a
+    replica, through this one.
+    """
+
+    if user_id in local_writers:
+        return True
+    if replica_engine is None:
+        return False
+
+    c = recent_writes_table.c
+    recent = exists().where(c.user_id == str(user_id),
+                            c.updated_at > func.now() - timedelta(seconds=READ_AFTER_WRITE_SECONDS))
+    # a short checkout of its own, the request's session may go on to read from the replica
+    with engine.connect() as connection:
+        return connection.execute(select(recent)).scalar()
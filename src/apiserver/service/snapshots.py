@@ -0,0 +1,199 @@
+import enum
+import hashlib
+import os
+import threading
+import time
+import uuid
+from typing import Dict, Tuple
+
+from sqlalchemy import Boolean, Date, Enum, Float, Integer, BigInteger, TIMESTAMP, func, select
+from sqlalchemy.orm import Session
+
+from apiserver.models import Submission, Vendor
+
+SNAPSHOT_CACHE_DIR = os.environ.get('SNAPSHOT_CACHE_DIR', '/tmp/apiserver-snapshots')
+SNAPSHOT_BATCH_SIZE = int(os.environ.get('SNAPSHOT_BATCH_SIZE', 5000))
+# outdated snapshots are kept until they haven't been served for this long
+SNAPSHOT_GRACE_SECONDS = float(os.environ.get('SNAPSHOT_GRACE_SECONDS', 300))
+
+
+class SnapshotFormat(str, enum.Enum):
+    parquet = 'parquet'
+    # Arrow IPC file, uncompressed so it can be memory-mapped
+    arrow = 'arrow'
+
+
+MEDIA_TYPES = {
+    SnapshotFormat.parquet: 'application/vnd.apache.parquet',
+    SnapshotFormat.arrow: 'application/vnd.apache.arrow.file',
+}
+
+# ids that only mean something inside this database, and the ingest content hash
+EXCLUDED_COLUMNS = {'project_id', 'vendor_id', 'content_hash'}
+
+_build_locks: Dict[str, threading.Lock] = {}
+_build_locks_lock = threading.Lock()
+
+
+def snapshot_columns():
+    columns = [Vendor.name.label('vendor')]
+    columns += [column for column in Submission.__table__.c if column.name not in EXCLUDED_COLUMNS]
+    columns += [Submission.total_media_cost.label('total_media_cost'), Submission.total_cost.label('total_cost'),
+                Submission.cpm.label('cpm')]
+    return columns
+
+
+def arrow_type(column):
+    import pyarrow as pa
+
+    sa_type = column.type
+    if isinstance(sa_type, Enum):
+        return pa.dictionary(pa.int8(), pa.string())
+    if isinstance(sa_type, Boolean):
+        return pa.bool_()
+    if isinstance(sa_type, BigInteger):
+        return pa.int64()
+    if isinstance(sa_type, Integer):
+        return pa.int32()
+    if isinstance(sa_type, Float):
+        return pa.float64()
+    if isinstance(sa_type, Date):
+        return pa.date32()
+    if isinstance(sa_type, TIMESTAMP):
+        return pa.timestamp('us')
+    # hybrids computed from floats have no declared type
+    if column.name in ('total_media_cost', 'total_cost', 'cpm'):
+        return pa.float64()
+    return pa.string()
+
+
+def snapshot_version(session: Session, project_id: int) -> str:
+    """
+    Changes whenever a submission of the project is written (updated_at) or removed (count), or one
+    of their vendors is (the file has the vendor names), so it identifies the snapshot file of the
+    project's current data.
+
+    updated_at is the start of the writing transaction, so a write that commits after a newer one
+    doesn't move max(updated_at). The sum of all of them still changes.
+    """
+
+    updated_at = func.extract('epoch', Submission.updated_at)
+    vendor_updated_at = func.extract('epoch', Vendor.updated_at)
+    query = select(func.max(updated_at), func.sum(updated_at), func.count(), func.max(vendor_updated_at))
+    query = query.join(Vendor, Vendor.id == Submission.vendor_id).where(Submission.project_id == project_id)
+    latest, total, count, vendors_latest = session.execute(query).one()
+
+    digest = hashlib.blake2b(f'{latest}:{total}:{vendors_latest}'.encode(), digest_size=8).hexdigest()
+    return f'{count}-{digest}'
+
+
+def snapshot_path(project_id: int, version: str, format: SnapshotFormat) -> str:
+    return os.path.join(SNAPSHOT_CACHE_DIR, f'{project_id}-{version}.{format.value}')
+
+
+def write_snapshot(session: Session, project_id: int, path: str, format: SnapshotFormat) -> int:
+    """
+    Write the project's submissions to `path`, a batch at a time from a server-side cursor, so
+    memory use doesn't grow with the project size.
+
+    :return: number of rows written.
+    """
+
+    import pyarrow as pa
+
+    columns = snapshot_columns()
+    schema = pa.schema([pa.field(column.name, arrow_type(column)) for column in columns])
+    # One dictionary per enum column, the enum's values in declaration order, shared by all batches:
+    # the Arrow IPC file format doesn't allow a dictionary to change between batches.
+    enum_columns = {i: {member: position for position, member in enumerate(column.type.enum_class)}
+                    for i, column in enumerate(columns) if isinstance(column.type, Enum)}
+    dictionaries = {i: pa.array([member.value for member in positions], pa.string())
+                    for i, positions in enum_columns.items()}
+
+    query = select(*columns).join(Vendor, Vendor.id == Submission.vendor_id)
+    query = query.where(Submission.project_id == project_id).order_by(Submission.id)
+    result = session.execute(query.execution_options(yield_per=SNAPSHOT_BATCH_SIZE))
+
+    if format == SnapshotFormat.parquet:
+        import pyarrow.parquet as pq
+        writer = pq.ParquetWriter(path, schema, compression='zstd')
+    else:
+        writer = pa.ipc.new_file(path, schema)
+
+    rows = 0
+    try:
+        for partition in result.partitions():
+            values = [list(column) for column in zip(*partition)]
+            for i, positions in enum_columns.items():
+                indices = pa.array([positions.get(value) for value in values[i]], pa.int8())
+                values[i] = pa.DictionaryArray.from_arrays(indices, dictionaries[i])
+
+            writer.write_batch(pa.record_batch(values, schema=schema))
+            rows += len(partition)
+    finally:
+        writer.close()
+        result.close()
+
+    return rows
+
+
+def get_snapshot(session: Session, project_id: int, format: SnapshotFormat) -> Tuple[str, str]:
+    """
+    Path and version of a snapshot of the project's current submissions, built on the first
+    request after they change and served from disk after that.
+    """
+
+    version = snapshot_version(session, project_id)
+    path = snapshot_path(project_id, version, format)
+    if _touch(path):
+        return path, version
+
+    # concurrent requests for the same snapshot wait for one build instead of each running it
+    with _build_locks_lock:
+        lock = _build_locks.setdefault(path, threading.Lock())
+
+    with lock:
+        if not os.path.exists(path):
+            os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            try:
+                write_snapshot(session, project_id, tmp_path, format)
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+            remove_stale_snapshots(project_id, format, keep=path)
+
+    with _build_locks_lock:
+        _build_locks.pop(path, None)
+
+    return path, version
+
+
+def _touch(path: str) -> bool:
+    """Mark the snapshot as just served, see remove_stale_snapshots. False if it doesn't exist."""
+
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def remove_stale_snapshots(project_id: int, format: SnapshotFormat, keep: str) -> None:
+    """
+    Remove the project's older snapshots that weren't served in the last SNAPSHOT_GRACE_SECONDS.
+    Another request (in any worker) may have just been handed one, and its response only opens the
+    file once it starts sending; files already open stay readable until closed.
+    """
+
+    cutoff = time.time() - SNAPSHOT_GRACE_SECONDS
+    for name in os.listdir(SNAPSHOT_CACHE_DIR):
+        path = os.path.join(SNAPSHOT_CACHE_DIR, name)
+        if name.startswith(f'{project_id}-') and name.endswith(f'.{format.value}') and path != keep:
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
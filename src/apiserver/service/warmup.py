@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from fastapi_sqlalchemy import db
+from sqlalchemy import desc, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import configure_mappers
+
+from apiserver.db.session import engine, replica_engine, DB_POOL_SIZE
+from apiserver.models import Project, Submission
+from apiserver.routes.auth_route import fetch_public_keys
+from apiserver.service.api_crud import submission_crud
+from apiserver.service.identity_cache import identity_cache
+
+WARMUP_ENABLED = os.environ.get('WARMUP_ENABLED', 'true').lower() == 'true'
+WARMUP_CONNECTIONS = min(int(os.environ.get('WARMUP_CONNECTIONS', DB_POOL_SIZE)), DB_POOL_SIZE)
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS', 2))
+
+
+def open_pool_connections(engine: Engine, count: int) -> None:
+    """Check out `count` connections at once so the pool keeps that many open when they are returned."""
+
+    connections = []
+    try:
+        for _ in range(count):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute(text('SELECT 1'))
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def open_all_pool_connections() -> None:
+    open_pool_connections(engine, WARMUP_CONNECTIONS)
+    if replica_engine is not None:
+        open_pool_connections(replica_engine, WARMUP_CONNECTIONS)
+
+
+def compile_hot_queries(replica: bool = False) -> None:
+    """
+    Run the statements behind the busiest endpoints once with parameters that match nothing, which
+    configures the mappers and puts the compiled SQL in the engine's statement cache. The queries
+    mirror the unfiltered first page of the project and submission listings, the wilkins_id lookup
+    and the selection stats. The statement cache is per engine, so this runs once for the replica too.
+    """
+
+    configure_mappers()
+
+    with db():
+        db.session.info['replica'] = replica
+        identity_cache.get_project_id('')
+
+        query = db.session.query(Project)
+        query.count()
+        query.order_by(desc(Project.created_at)).limit(10).offset(0).all()
+
+        query = db.session.query(Submission).filter(Submission.project_id == 0)
+        query.count()
+        query.limit(10).offset(0).all()
+
+        submission_crud.selection_stats(0)
+
+
+class WarmUp:
+    """
+    Start-up work that would otherwise land on the first requests after a deploy or scale-out.
+    Opening the pool connections has to succeed (it is retried until it does); fetching the signing
+    keys and compiling queries are best effort.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.stopping = threading.Event()
+        self.timings: Dict[str, float] = {}
+        self.errors: Dict[str, str] = {}
+
+    def run(self) -> None:
+        if not WARMUP_ENABLED:
+            self.ready.set()
+            return
+
+        start = time.perf_counter()
+
+        while not self.stopping.is_set():
+            if self._step('connections', open_all_pool_connections):
+                break
+            self.stopping.wait(WARMUP_RETRY_SECONDS)
+        else:
+            return
+
+        if os.environ.get('TENANT_ID') and os.environ.get('APP_CLIENT_ID'):
+            self._step('public_keys', fetch_public_keys)
+        self._step('queries', compile_hot_queries)
+        if replica_engine is not None:
+            self._step('replica_queries', lambda: compile_hot_queries(replica=True))
+
+        self.timings['total'] = round((time.perf_counter() - start) * 1000, 1)
+        print(f'Warm-up finished in {self.timings["total"]} ms: {self.timings}')
+        self.ready.set()
+
+    def stop(self) -> None:
+        self.stopping.set()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            'status': 'ready' if self.ready.is_set() else 'warming',
+            'timings_ms': self.timings,
+            'errors': self.errors,
+        }
+
+    def _step(self, name: str, func: Callable[[], Any]) -> bool:
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            print(f'Warm-up step {name} failed: {e}')
+            self.errors[name] = str(e)
+            return False
+
+        self.errors.pop(name, None)
+        self.timings[name] = round((time.perf_counter() - start) * 1000, 1)
+        return True
+
+
+warmup = WarmUp()
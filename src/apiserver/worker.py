@@ -0,0 +1,67 @@
+import os
+import signal
+import socket
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from apiserver.service.jobs import claim_job, run_job, enqueue_job_once
+
+# Every worker queues a rollup refresh this often (seconds, 0 disables), at most one is pending at a time
+ROLLUP_REFRESH_INTERVAL = float(os.environ.get('ROLLUP_REFRESH_INTERVAL', 300))
+
+
+class Worker:
+    """
+    Polls the jobs table and runs one job at a time.
+
+    Uses its own small engine, so long-running jobs never hold HTTP workers or connections from
+    the API's request pool. Run as `python -m apiserver.worker`; start more processes to run
+    jobs in parallel.
+    """
+
+    def __init__(self, db_url: str, poll_interval: float):
+        # one connection for the job itself, one for progress/heartbeat updates
+        self.engine = create_engine(db_url, pool_size=2, max_overflow=0, pool_pre_ping=True)
+        self.Session = sessionmaker(bind=self.engine)
+        self.poll_interval = poll_interval
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = False
+        self.next_rollup_refresh = time.monotonic()
+
+    def stop(self, *args) -> None:
+        print(f'Worker {self.worker_id} stopping after the current job')
+        self.stopping = True
+
+    def schedule_jobs(self, session) -> None:
+        if ROLLUP_REFRESH_INTERVAL <= 0 or time.monotonic() < self.next_rollup_refresh:
+            return
+
+        self.next_rollup_refresh = time.monotonic() + ROLLUP_REFRESH_INTERVAL
+        enqueue_job_once(session, 'refresh_portfolio_rollups', created_by=self.worker_id)
+
+    def run(self) -> None:
+        print(f'Worker {self.worker_id} started')
+        while not self.stopping:
+            with self.Session() as session:
+                self.schedule_jobs(session)
+
+                job = claim_job(session, self.worker_id)
+                if job is None:
+                    time.sleep(self.poll_interval)
+                    continue
+
+                print(f'Worker {self.worker_id} running job {job.id} ({job.kind})')
+                run_job(session, job)
+
+
+def main():
+    worker = Worker(os.environ['DATABASE_URL'], poll_interval=float(os.environ.get('JOB_POLL_INTERVAL', 2)))
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    worker.run()
+
+
+if __name__ == '__main__':
+    main()